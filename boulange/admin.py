@@ -12,9 +12,12 @@ from .models import (
     OrderLine,
     Product,
     ProductLine,
+    RecipeVersion,
     Settings,
+    StockMovement,
     WeeklyDelivery,
 )
+from .stock import record_stock_movements
 
 admin.site.unregister(Group)
 
@@ -35,8 +38,27 @@ class ProductAdmin(admin.ModelAdmin):
     save_as = True
 
 
+class RecipeVersionAdmin(admin.ModelAdmin):
+    "Created when an order line is placed with a recipe not seen before, never edited"
+
+    list_display = ("product", "created", "cost_price")
+    list_filter = ("product",)
+    fields = ["product", "created", "cost_price", "snapshot"]
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Product, ProductAdmin)
+admin.site.register(RecipeVersion, RecipeVersionAdmin)
 
 
 class CustomerAdmin(admin.ModelAdmin):
@@ -62,7 +84,7 @@ def generate_delivery_dates(modeladmin, request, queryset):
 
 
 class WeeklyDeliveryAdmin(admin.ModelAdmin):
-    list_display = ("customer", "day_of_week", "active", "public_delivery_point", "online_payment")
+    list_display = ("customer", "day_of_week", "active", "bakery_lead_days", "preparation_lead_days", "public_delivery_point", "online_payment")
     list_filter = ("active", "day_of_week")
     filter_horizontal = ("allowed_customers",)
     model = WeeklyDelivery
@@ -101,6 +123,9 @@ class OrderInline(admin.TabularInline):
     can_delete = True
     show_change_link = True
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals().select_related("customer")
+
 
 class DeliveryDateAdmin(admin.ModelAdmin):
     list_display = ("weekly_delivery", "date", "active")
@@ -159,6 +184,7 @@ class OrderLineInline(admin.TabularInline):
     model = OrderLine
     extra = 3
     autocomplete_fields = ["product"]
+    readonly_fields = ["unit_price", "discount", "total"]
 
 
 class OrderAdmin(admin.ModelAdmin):
@@ -180,3 +206,30 @@ class SettingsAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Settings, SettingsAdmin)
+
+
+class StockMovementAdmin(admin.ModelAdmin):
+    "Deliveries and inventories are entered here, the consumption is posted from the plans"
+
+    list_display = ("day", "ingredient", "kind", "quantity", "balance")
+    list_filter = ("kind", ("day", MyDateFilter), "ingredient")
+    fields = ["ingredient", "day", "kind", "quantity"]
+
+    def formfield_for_choice_field(self, db_field, request, **kwargs):
+        if db_field.name == "kind":
+            kwargs["choices"] = [(kind, label) for kind, label in StockMovement.KIND.items() if kind != "consumption"]
+        return super().formfield_for_choice_field(db_field, request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        # the balance is computed when recording, the days after rebalanced
+        (movement,) = record_stock_movements(obj.day, obj.kind, {obj.ingredient_id: obj.quantity})
+        obj.pk, obj.quantity, obj.balance = movement.pk, movement.quantity, movement.balance
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+admin.site.register(StockMovement, StockMovementAdmin)
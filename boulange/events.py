@@ -0,0 +1,63 @@
+"""Server-sent events of the actions page.
+
+A stream follows the change feed of one day: every POLL_SECONDS it reads the
+plan version, a single aggregate over PlanChange. Only when the version moved
+is the plan read, from the plan cache, and the digest of each printable section
+compared with the previous one: an event named after the section is sent for
+each one that changed, its data being the new version. Nothing is needed but
+the database, so it runs in the ASGI process itself (see the
+BOULANGE_LIVE_ACTIONS setting). A stream ends after MAX_STREAM_SECONDS and
+the browser connects again, from the last version it received.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from .planning import SECTIONS, get_cached_actions, get_plan_version
+from .snapshots import get_digest, get_plan_lines
+
+# how often the change feed is read, in seconds
+POLL_SECONDS = 2
+# comment sent when nothing happened for that long, so that proxies keep the connection
+KEEPALIVE_SECONDS = 30
+# browsers connect again after that many milliseconds when the stream ends
+RETRY_MILLISECONDS = 5000
+# lifetime of a stream
+MAX_STREAM_SECONDS = 300
+
+
+def get_section_digests(day):
+    "{section: digest} of the actions of day"
+    actions = get_cached_actions(day)
+    return {section: get_digest(get_plan_lines(actions, section)) for section in SECTIONS}
+
+
+def _event(name, version):
+    return f"event: {name}\nid: {version}\ndata: {version}\n\n"
+
+
+async def plan_events(day, version, max_seconds=MAX_STREAM_SECONDS):
+    """SSE messages of the sections of day changed after the given plan version
+    (every section when version is unknown), for max_seconds or forever when None"""
+    digests = None
+    if version is not None:
+        current, _ = await sync_to_async(get_plan_version)(day, day)
+        if current == version:
+            digests = await sync_to_async(get_section_digests)(day)
+    yield f"retry: {RETRY_MILLISECONDS}\n\n"
+    loop = asyncio.get_running_loop()
+    started = last_sent = loop.time()
+    while max_seconds is None or loop.time() - started < max_seconds:
+        current, _ = await sync_to_async(get_plan_version)(day, day)
+        if current != version:
+            new_digests = await sync_to_async(get_section_digests)(day)
+            for section, digest in new_digests.items():
+                if digests is None or digests[section] != digest:
+                    yield _event(section, current)
+                    last_sent = loop.time()
+            version, digests = current, new_digests
+        if loop.time() - last_sent >= KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = loop.time()
+        await asyncio.sleep(POLL_SECONDS)
@@ -0,0 +1,136 @@
+"""Ingredient purchasing forecast.
+
+Totals the raw ingredients needed by the orders delivered over a window, from a
+single aggregate over the order lines: the quantities are summed per bakery day
+and product, so that batch-baking rounding is the same as in the day plans, and
+each recipe is then expanded once per product whatever the length of the window.
+"""
+
+import logging
+from collections.abc import Mapping
+
+from django.core.cache import caches
+
+from .levain import get_levain_ratio
+from .models import (
+    ORDER_WINDOW_DAYS,
+    IdMapping,
+    PreparationBatch,
+    get_compiled_ingredient,
+    get_compiled_product,
+    get_compiled_recipe,
+    get_compiled_versions,
+    get_planning_days,
+    sync_catalogue,
+)
+from .planning import get_delivery_version, get_order_totals
+from .singleflight import single_flight
+
+logger = logging.getLogger(__name__)
+
+# longest window a forecast can cover: every day customers can order for
+MAX_FORECAST_DAYS = ORDER_WINDOW_DAYS + 1
+
+
+class IngredientForecast(Mapping):
+    """ingredients ({ingredient id: quantity to buy}), levain and trempage (as in
+    PreparationBatch), read keyed by Ingredient.
+
+    Soaked ingredients are counted dry in ingredients and their soaking water
+    with the soaking ingredient. Levains are made here: they show in levain, and
+    in ingredients as the flour and water they are fed with (only as themselves
+    when these are not set on the levain).
+    """
+
+    __slots__ = ("products", "versions", "ingredients", "preparation")
+    KEYS = ("ingredients", "levain", "trempage")
+
+    def __init__(self):
+        # product id -> quantity baked
+        self.products = {}
+        # RecipeVersion id -> quantity baked, for the lines placed with an older recipe
+        self.versions = {}
+        self.ingredients = {}
+        self.preparation = PreparationBatch()
+
+    def add(self, product_id, quantity):
+        "quantity of product_id, baked on a single day"
+        quantity = get_compiled_product(product_id).get_baked_quantity(quantity)
+        self.products[product_id] = self.products.get(product_id, 0) + quantity
+        self.preparation.finalize_product(product_id, quantity)
+
+    def add_version(self, recipe_version_id, quantity):
+        "quantity of a product baked on a single day with the recipe of a RecipeVersion, expanded by finalize"
+        self.versions[recipe_version_id] = self.versions.get(recipe_version_id, 0) + quantity
+
+    def finalize(self):
+        recipes = [(get_compiled_recipe(product_id), quantity) for product_id, quantity in self.products.items()]
+        for version_id, recipe in get_compiled_versions(self.versions).items():
+            self.versions[version_id] = quantity = recipe.product.get_baked_quantity(self.versions[version_id])
+            self.preparation.finalize_product(recipe.product.pk, quantity, recipe)
+            recipes.append((recipe, quantity))
+        for recipe, quantity in recipes:
+            for ingref in ("direct", "base_product"):
+                for ingredient, ing_qty in recipe.ingredients[ingref].items():
+                    self.ingredients[ingredient.pk] = self.ingredients.get(ingredient.pk, 0) + ing_qty * quantity
+        # the seed of a levain stage is the previous one: the whole levain is fed flour and water
+        _, flour, water = get_levain_ratio()
+        for ingredient_id, total in self.preparation.levain.items():
+            levain = get_compiled_ingredient(ingredient_id)
+            if levain.levain_flour_id is None or levain.levain_water_id is None:
+                logger.warning("%s: no levain flour or water, bought as is", levain)
+                continue
+            self.ingredients.pop(ingredient_id)
+            for fed_id, part in ((levain.levain_flour_id, flour), (levain.levain_water_id, water)):
+                self.ingredients[fed_id] = self.ingredients.get(fed_id, 0) + total * part / (flour + water)
+        # the recipes hold the soaked weight, move the water back to its ingredient
+        for ingredient_id, soaking in self.preparation.trempage.items():
+            self.ingredients[ingredient_id] -= soaking.soaking_qty
+            self.ingredients[soaking.soaking_ingredient_id] = self.ingredients.get(soaking.soaking_ingredient_id, 0) + soaking.soaking_qty
+        self.ingredients = dict(sorted(self.ingredients.items(), key=lambda item: get_compiled_ingredient(item[0]).name))
+
+    def __getitem__(self, key):
+        if key == "ingredients":
+            return IdMapping(self.ingredients, get_compiled_ingredient)
+        if key in self.KEYS:
+            return self.preparation[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+
+def build_ingredient_forecast(start, end, include_unvalidated=False):
+    "IngredientForecast of the orders delivered from start to end, carts not paid yet included on demand"
+    baked = {}
+    for total in get_order_totals(start, end, include_unvalidated=include_unvalidated):
+        _, bakery_day, _ = get_planning_days(total["date"], total["bakery_lead_days"], total["preparation_lead_days"])
+        key = (bakery_day, total["product"])
+        baked[key] = baked.get(key, 0) + total["quantity"]
+    forecast = IngredientForecast()
+    for (_, product_id), quantity in baked.items():
+        forecast.add(product_id, quantity)
+    forecast.finalize()
+    return forecast
+
+
+def get_cached_ingredient_forecast(start, end, include_unvalidated=False):
+    """build_ingredient_forecast through the "plans" cache, stored under the data
+    version of the orders of the window."""
+    version, _ = get_delivery_version(start, end)
+    key = f"forecast:{start.isoformat()}:{end.isoformat()}:{'all' if include_unvalidated else 'validated'}:{version}"
+    forecast = caches["plans"].get(key)
+    if forecast is not None:
+        return forecast
+
+    def build():
+        # see planning._build_missing_plans
+        sync_catalogue()
+        forecast = build_ingredient_forecast(start, end, include_unvalidated)
+        caches["plans"].set(key, forecast)
+        return forecast
+
+    return single_flight("forecast", key, build)
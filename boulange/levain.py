@@ -0,0 +1,79 @@
+"""Levain build schedule.
+
+A levain is built in "Nb steps levain" feedings: each one mixes the previous
+stage (the starter for the first one) with flour and water, in the "Ratio
+levain" seed:flour:water proportions. Working back from the preparation total
+gives the quantities of every stage. The first feeding is done at "Début
+levain", the next ones "Durée étape levain" hours apart.
+"""
+
+import logging
+from collections.abc import Mapping
+from datetime import date, datetime, time, timedelta
+
+from .models import get_setting
+
+logger = logging.getLogger(__name__)
+
+NB_STEPS = 1
+RATIO = (1.0, 1.0, 1.0)
+STEP_HOURS = 4.0
+START = time(8, 0)
+
+
+class LevainStep(Mapping):
+    "One feeding: the time it is done and the seed, flour and water quantities mixed"
+
+    __slots__ = ("time", "seed", "flour", "water")
+    KEYS = ("time", "seed", "flour", "water")
+
+    def __init__(self, time, seed, flour, water):
+        self.time = time
+        self.seed = seed
+        self.flour = flour
+        self.water = water
+
+    @property
+    def total(self):
+        return self.seed + self.flour + self.water
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+
+def get_levain_ratio():
+    """seed:flour:water proportions of "Ratio levain", RATIO when they are not
+    all positive or zero, or feed no flour nor water"""
+    seed, flour, water = ratio = get_setting("Ratio levain", RATIO)
+    if min(ratio) < 0 or flour + water <= 0:
+        logger.warning("setting Ratio levain: can't use %r, using %r", ratio, RATIO)
+        return RATIO
+    return ratio
+
+
+def get_levain_steps(total):
+    "LevainStep list, in feeding order, building total grams of levain"
+    nb_steps = max(1, get_setting("Nb steps levain", NB_STEPS))
+    seed, flour, water = get_levain_ratio()
+    step = timedelta(hours=get_setting("Durée étape levain", STEP_HOURS))
+    start = datetime.combine(date.min, get_setting("Début levain", START))
+    quantities = []
+    for _ in range(nb_steps):
+        ratio = total / (seed + flour + water)
+        quantities.append((seed * ratio, flour * ratio, water * ratio))
+        # the seed of a stage is the whole previous one
+        total = seed * ratio
+    return [LevainStep((start + i * step).time(), *stage) for i, stage in enumerate(reversed(quantities))]
+
+
+def plan_levain_builds(batch):
+    "Fill the levain_builds of a finalized PreparationBatch from its levain totals"
+    batch.levain_builds = {ingredient_id: get_levain_steps(total) for ingredient_id, total in batch.levain.items()}
@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from boulange.planning import build_actions
+from boulange.recipe_matrix import compare_actions
+
+
+class Command(BaseCommand):
+    help = "Compute the actions of a range of days with both planning engines and report any difference"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start", type=date.fromisoformat, default=None, help="first day (YYYY-MM-DD), defaults to today")
+        parser.add_argument("--days", type=int, default=7)
+        parser.add_argument("--tolerance", type=float, default=1e-6)
+
+    def handle(self, *args, **options):
+        start = options["start"] or date.today()
+        timings = {"python": 0, "numpy": 0}
+        nb_differences = 0
+        for i in range(options["days"]):
+            day = start + timedelta(days=i)
+            results = {}
+            for engine in timings:
+                begin = perf_counter()
+                results[engine] = build_actions(day, engine=engine)
+                timings[engine] += perf_counter() - begin
+            differences = compare_actions(results["python"], results["numpy"], options["tolerance"], path=str(day))
+            for difference in differences:
+                self.stdout.write(self.style.ERROR(difference))
+            nb_differences += len(differences)
+        for engine, duration in timings.items():
+            self.stdout.write(f"{engine}: {duration * 1000:.1f} ms")
+        if nb_differences:
+            self.stdout.write(self.style.ERROR(f"{nb_differences} differences"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Both engines agree"))
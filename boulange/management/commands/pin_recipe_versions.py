@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from boulange.models import OrderLine, get_current_recipe_version
+from boulange.planning import refresh_production_plan
+
+
+class Command(BaseCommand):
+    help = "Point the order lines placed before the recipe versions existed to the current recipes, so that their plans no longer follow the recipe changes"
+
+    def handle(self, *args, **options):
+        lines = OrderLine.objects.filter(recipe_version__isnull=True)
+        product_ids = set(lines.values_list("product", flat=True).distinct())
+        delivery_date_ids = set(lines.values_list("order__delivery_date", flat=True).distinct())
+        with transaction.atomic():
+            pinned = sum(lines.filter(product=product_id).update(recipe_version=get_current_recipe_version(product_id)) for product_id in product_ids)
+            # same quantities, only the plan rows now carry the versions
+            refresh_production_plan(delivery_date_ids)
+        self.stdout.write(self.style.SUCCESS(f"{pinned} order lines pinned to the recipes of {len(product_ids)} products"))
@@ -0,0 +1,17 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from boulange.stock import post_stock_consumption
+
+
+class Command(BaseCommand):
+    help = "Post the ingredients used by the plans of the past days to the stock ledger (to be run at midnight)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--until", type=date.fromisoformat, default=None, help="last day to post (YYYY-MM-DD), defaults to yesterday")
+
+    def handle(self, *args, **options):
+        until = options["until"] or date.today() - timedelta(days=1)
+        posted = post_stock_consumption(until)
+        self.stdout.write(self.style.SUCCESS(f"Consumption of {posted} days posted until {until}"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from boulange.planning import prune_plan_changes
+
+
+class Command(BaseCommand):
+    help = "Delete the plan changes no data version depends on anymore (to be run at midnight)"
+
+    def handle(self, *args, **options):
+        deleted = prune_plan_changes()
+        self.stdout.write(self.style.SUCCESS(f"{deleted} plan changes deleted"))
@@ -0,0 +1,58 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from boulange.models import ProductionPlan, StaleProductionPlan
+from boulange.planning import compute_plan_rows, get_order_totals
+
+
+class Command(BaseCommand):
+    help = "Rebuild the production plan from the orders, or check it against a full recomputation"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start", type=date.fromisoformat, default=None, help="first delivery day (YYYY-MM-DD)")
+        parser.add_argument("--to", dest="end", type=date.fromisoformat, default=None, help="last delivery day (YYYY-MM-DD)")
+        parser.add_argument("--check", action="store_true", help="only report the differences")
+
+    def handle(self, *args, **options):
+        start, end = options["start"], options["end"]
+        stored = ProductionPlan.objects.all()
+        stale = StaleProductionPlan.objects.all()
+        if start is not None:
+            stored = stored.filter(delivery_date__date__gte=start)
+            stale = stale.filter(delivery_date__date__gte=start)
+        if end is not None:
+            stored = stored.filter(delivery_date__date__lte=end)
+            stale = stale.filter(delivery_date__date__lte=end)
+        computed = list(compute_plan_rows(get_order_totals(start, end)))
+
+        if not options["check"]:
+            with transaction.atomic():
+                stored.delete()
+                ProductionPlan.objects.bulk_create(computed)
+                stale.delete()
+            self.stdout.write(self.style.SUCCESS(f"{len(computed)} rows rebuilt"))
+            return
+
+        # flagged delivery dates are refreshed on next read, they are expected to differ
+        pending = set(stale.values_list("delivery_date", flat=True))
+
+        def key(row):
+            return (row.day, row.kind, row.delivery_date_id, row.product_id, row.recipe_version_id)
+
+        expected = {key(row): row.quantity for row in computed if row.delivery_date_id not in pending}
+        actual = {key(row): row.quantity for row in stored if row.delivery_date_id not in pending}
+        differences = [
+            f"{k[0]} {k[1]} delivery date {k[2]} product {k[3]} recipe version {k[4]}: {expected.get(k)} != {actual.get(k)}"
+            for k in sorted(expected.keys() | actual.keys(), key=lambda k: (*k[:4], k[4] or 0))
+            if expected.get(k) != actual.get(k)
+        ]
+        for difference in differences:
+            self.stdout.write(self.style.ERROR(difference))
+        if pending:
+            self.stdout.write(f"{len(pending)} delivery dates waiting for a refresh")
+        if differences:
+            self.stdout.write(self.style.ERROR(f"{len(differences)} differences"))
+        else:
+            self.stdout.write(self.style.SUCCESS("The production plan is up to date"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from boulange.singleflight import get_names, get_stats
+
+
+class Command(BaseCommand):
+    help = "Report how often concurrent identical computations were coalesced"
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help="every name single_flight counted events of by default")
+
+    def handle(self, *args, **options):
+        for name in options["names"] or get_names():
+            stats = get_stats(name)
+            total = stats["computed"] + stats["coalesced"] + stats["timeouts"]
+            ratio = stats["coalesced"] / total if total else 0
+            self.stdout.write(f"{name}: {stats['computed']} computed, {stats['coalesced']} coalesced ({ratio:.0%}), {stats['timeouts']} timeouts")
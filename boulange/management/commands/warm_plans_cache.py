@@ -0,0 +1,21 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from boulange.planning import NAV_DAYS, get_cached_range_actions
+
+
+class Command(BaseCommand):
+    help = "Build the plans of the coming days into the plans cache (to be run at midnight)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="start", type=date.fromisoformat, default=None, help="first day (YYYY-MM-DD), defaults to today")
+        parser.add_argument("--days", type=int, default=3, help="number of days after the first one")
+
+    def handle(self, *args, **options):
+        start = options["start"] or date.today()
+        end = start + timedelta(days=options["days"])
+        # with the neighbours the actions page of each of these days would build
+        plans = get_cached_range_actions(start - timedelta(days=NAV_DAYS), end + timedelta(days=NAV_DAYS))
+        planned = [day for day, actions in plans.items() if actions is not None]
+        self.stdout.write(self.style.SUCCESS(f"{len(plans)} days cached ({len(planned)} with actions) around {start} - {end}"))
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0027_alter_resetaccounttoken_created_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StaleProductionPlan",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("delivery_date", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to="boulange.deliverydate")),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ProductionPlan",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField()),
+                ("kind", models.CharField(choices=[("delivery", "livraison"), ("bakery", "boulange"), ("preparation", "préparation")], max_length=20)),
+                ("quantity", models.IntegerField()),
+                ("delivery_date", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="boulange.deliverydate")),
+                ("product", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="boulange.product")),
+            ],
+            options={
+                "verbose_name": "Plan de production",
+                "indexes": [models.Index(fields=["day", "kind"], name="boulange_pr_day_5e2a3e_idx")],
+                "unique_together": {("day", "kind", "delivery_date", "product")},
+            },
+        ),
+    ]
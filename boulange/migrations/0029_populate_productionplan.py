@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:05
+
+from django.db import migrations
+
+
+def mark_planned_delivery_dates(apps, schema_editor):
+    # the rows are computed from the orders on first read
+    DeliveryDate = apps.get_model("boulange", "DeliveryDate")
+    StaleProductionPlan = apps.get_model("boulange", "StaleProductionPlan")
+    delivery_dates = DeliveryDate.objects.filter(order__validated=True).values_list("pk", flat=True).distinct()
+    StaleProductionPlan.objects.bulk_create([StaleProductionPlan(delivery_date_id=pk) for pk in delivery_dates])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0028_staleproductionplan_productionplan"),
+    ]
+
+    operations = [migrations.RunPython(mark_planned_delivery_dates, migrations.RunPython.noop)]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0029_populate_productionplan"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PlanChange",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("delivery_date", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="boulange.deliverydate")),
+            ],
+            options={
+                "verbose_name": "Changement de plan",
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0030_planchange"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weeklydelivery",
+            name="bakery_lead_days",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="weeklydelivery",
+            name="preparation_lead_days",
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name="deliverydate",
+            index=models.Index(fields=["date", "active"], name="boulange_de_date_f854d3_idx"),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:10
+
+from django.db import migrations
+
+
+def set_bakery_lead_days(apps, schema_editor):
+    WeeklyDelivery = apps.get_model("boulange", "WeeklyDelivery")
+    WeeklyDelivery.objects.filter(batch_target="PREVIOUS_DAY").update(bakery_lead_days=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0031_weeklydelivery_bakery_lead_days_and_more"),
+    ]
+
+    operations = [migrations.RunPython(set_bakery_lead_days, migrations.RunPython.noop)]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:11
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0032_migrate_batch_target"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="weeklydelivery",
+            name="batch_target",
+        ),
+    ]
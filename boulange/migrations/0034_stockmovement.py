@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0033_remove_weeklydelivery_batch_target"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StockMovement",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField()),
+                ("kind", models.CharField(choices=[("delivery", "livraison"), ("consumption", "consommation"), ("inventory", "inventaire")], max_length=20)),
+                ("quantity", models.FloatField()),
+                ("balance", models.FloatField(editable=False)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("ingredient", models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name="stock_movements", to="boulange.ingredient")),
+            ],
+            options={
+                "verbose_name": "Mouvement de stock",
+                "indexes": [models.Index(fields=["ingredient", "-id"], name="boulange_st_ingredi_c12fe0_idx"), models.Index(fields=["kind", "day"], name="boulange_st_kind_485300_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0034_stockmovement"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="bake_minutes",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="oven_space",
+            field=models.FloatField(default=1, help_text="room taken by one unit in an oven run"),
+        ),
+    ]
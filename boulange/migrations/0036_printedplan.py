@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0035_product_oven"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PrintedPlan",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField()),
+                ("section", models.CharField(max_length=20)),
+                ("digest", models.CharField(max_length=64)),
+                ("lines", models.JSONField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "Plan imprimé",
+                "indexes": [models.Index(fields=["day", "section", "-id"], name="boulange_pr_day_dfd924_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0036_printedplan"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="planchange",
+            name="catalogue",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="RecipeVersion",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("digest", models.CharField(max_length=64)),
+                ("snapshot", models.JSONField()),
+                ("cost_price", models.DecimalField(decimal_places=4, max_digits=10)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("product", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="recipe_versions", to="boulange.product")),
+            ],
+            options={
+                "verbose_name": "Version de recette",
+                "unique_together": {("product", "digest")},
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name="productionplan",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="orderline",
+            name="recipe_version",
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to="boulange.recipeversion"),
+        ),
+        migrations.AddField(
+            model_name="productionplan",
+            name="recipe_version",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to="boulange.recipeversion"),
+        ),
+        migrations.AlterUniqueTogether(
+            name="productionplan",
+            unique_together={("day", "kind", "delivery_date", "product", "recipe_version")},
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:56
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+# boulange.units and SPECIAL_UNITS_WEIGHTS when this migration was written
+BASE_UNITS = 1000
+MICROCENTS = 10**8
+SPECIAL_UNITS_WEIGHTS = {"oeufs": 60, "blancs": 40, "jaunes": 20}
+
+
+def get_base_quantity(quantity):
+    return round(quantity * BASE_UNITS)
+
+
+def get_unit_price(unit, per_unit_price):
+    price = Decimal(str(per_unit_price)) * MICROCENTS
+    if unit == "g":
+        price /= 1000
+    return int(price.to_integral_value())
+
+
+def get_unit_weight(unit):
+    if unit == "g":
+        return 1
+    return SPECIAL_UNITS_WEIGHTS.get(unit)
+
+
+def normalize_recipes(apps, schema_editor):
+    Ingredient = apps.get_model("boulange", "Ingredient")
+    ProductLine = apps.get_model("boulange", "ProductLine")
+    ingredients = list(Ingredient.objects.all())
+    for ingredient in ingredients:
+        ingredient.unit_price = get_unit_price(ingredient.unit, ingredient.per_unit_price)
+        ingredient.unit_weight = get_unit_weight(ingredient.unit)
+    Ingredient.objects.bulk_update(ingredients, ["unit_price", "unit_weight"])
+    lines = list(ProductLine.objects.all())
+    for line in lines:
+        line.base_quantity = get_base_quantity(line.quantity)
+    ProductLine.objects.bulk_update(lines, ["base_quantity"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0037_recipe_versions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ingredient",
+            name="unit_price",
+            field=models.BigIntegerField(default=0, editable=False, help_text="micro-cents per g, liter or unit"),
+        ),
+        migrations.AddField(
+            model_name="ingredient",
+            name="unit_weight",
+            field=models.IntegerField(editable=False, help_text="mg per thousandth of unit", null=True),
+        ),
+        migrations.AddField(
+            model_name="productline",
+            name="base_quantity",
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(normalize_recipes, migrations.RunPython.noop),
+    ]
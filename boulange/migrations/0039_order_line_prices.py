@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# models.TVA when this migration was written
+TVA = Decimal("5.5")
+
+
+def freeze_order_line_prices(apps, schema_editor):
+    # the prices of the past orders are lost: the current ones are the best guess
+    OrderLine = apps.get_model("boulange", "OrderLine")
+    lines = list(OrderLine.objects.filter(Q(order__validated=True) | Q(order__checkout__isnull=False)).select_related("product", "order__customer"))
+    for line in lines:
+        customer = line.order.customer
+        line.discount = Decimal(0)
+        if customer.is_professional:
+            line.discount = 1 - (1 - TVA / 100) * (1 - Decimal(str(customer.pro_discount_percentage)) / 100)
+        line.unit_price = line.product.price
+        line.total = line.unit_price * line.quantity * (1 - line.discount)
+    OrderLine.objects.bulk_update(lines, ["unit_price", "discount", "total"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0038_normalized_units"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="orderline",
+            name="discount",
+            field=models.DecimalField(blank=True, decimal_places=8, editable=False, help_text="part of the price taken off (TVA and pro discount)", max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name="orderline",
+            name="total",
+            field=models.DecimalField(blank=True, decimal_places=8, editable=False, max_digits=14, null=True),
+        ),
+        migrations.AddField(
+            model_name="orderline",
+            name="unit_price",
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=5, null=True),
+        ),
+        migrations.RunPython(freeze_order_line_prices, migrations.RunPython.noop),
+    ]
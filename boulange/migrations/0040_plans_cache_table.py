@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_plans_cache_table(apps, schema_editor):
+    # the "plans" DatabaseCache shared by the gunicorn workers: nothing else runs createcachetable
+    call_command("createcachetable", database=schema_editor.connection.alias, verbosity=0)
+
+
+def drop_plans_cache_table(apps, schema_editor):
+    schema_editor.execute(f"DROP TABLE IF EXISTS {schema_editor.quote_name(settings.CACHES['plans']['LOCATION'])}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0039_order_line_prices"),
+    ]
+
+    operations = [migrations.RunPython(create_plans_cache_table, drop_plans_cache_table)]
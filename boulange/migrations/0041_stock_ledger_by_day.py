@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+def rebalance_ledger(apps, schema_editor):
+    # drop the days posted twice, then replay the ledger in (day, id) order
+    StockMovement = apps.get_model("boulange", "StockMovement")
+    seen = set()
+    duplicates = []
+    balances = {}
+    changed = []
+    for movement in StockMovement.objects.order_by("day", "pk"):
+        if movement.kind == "consumption":
+            if (movement.ingredient_id, movement.day) in seen:
+                duplicates.append(movement.pk)
+                continue
+            seen.add((movement.ingredient_id, movement.day))
+        previous = balances.get(movement.ingredient_id, 0)
+        if movement.kind == "inventory":
+            # the counted stock stays
+            movement.quantity = movement.balance - previous
+        else:
+            movement.balance = previous + movement.quantity
+        balances[movement.ingredient_id] = movement.balance
+        changed.append(movement)
+    StockMovement.objects.filter(pk__in=duplicates).delete()
+    StockMovement.objects.bulk_update(changed, ["quantity", "balance"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0040_plans_cache_table"),
+    ]
+
+    operations = [
+        migrations.RunPython(rebalance_ledger, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name="stockmovement",
+            name="boulange_st_ingredi_c12fe0_idx",
+        ),
+        migrations.AddIndex(
+            model_name="stockmovement",
+            index=models.Index(fields=["ingredient", "-day", "-id"], name="boulange_st_ingredi_eb35e2_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="stockmovement",
+            constraint=models.UniqueConstraint(condition=models.Q(("kind", "consumption")), fields=("ingredient", "day"), name="unique_daily_consumption"),
+        ),
+    ]
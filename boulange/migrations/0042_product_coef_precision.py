@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+import boulange.units
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0041_stock_ledger_by_day"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="product",
+            name="coef",
+            field=models.FloatField(default=1, validators=[boulange.units.validate_coef]),
+        ),
+    ]
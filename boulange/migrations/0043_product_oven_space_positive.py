@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:07
+
+import django.core.validators
+from django.db import migrations, models
+
+import boulange.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0042_product_coef_precision"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="product",
+            name="oven_space",
+            field=models.FloatField(default=1, help_text="room taken by one unit in an oven run", validators=[django.core.validators.MinValueValidator(0), boulange.models.validate_positive]),
+        ),
+    ]
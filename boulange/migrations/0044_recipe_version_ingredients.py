@@ -0,0 +1,32 @@
+import hashlib
+import json
+
+from django.db import migrations
+
+# RecipeVersion.INGREDIENT_FIELDS when this migration was written
+INGREDIENT_FIELDS = ("name", "unit", "soaking_ingredient_id", "soaking_coef", "decimal_round", "unit_weight")
+
+
+def keep_ingredient_fields(apps, schema_editor):
+    # the ingredients as they are now are the best guess of what they were;
+    # the digest follows the snapshot, as CompiledRecipe.digest computes it
+    Ingredient = apps.get_model("boulange", "Ingredient")
+    RecipeVersion = apps.get_model("boulange", "RecipeVersion")
+    ingredients = {str(pk): fields for pk, *fields in Ingredient.objects.values_list("pk", *INGREDIENT_FIELDS)}
+    versions = list(RecipeVersion.objects.all())
+    for version in versions:
+        ids = {pk for values in version.snapshot["ingredients"].values() for pk in values}
+        version.snapshot["ingredient_fields"] = {pk: dict(zip(INGREDIENT_FIELDS, ingredients[pk])) for pk in ids if pk in ingredients}
+        version.digest = hashlib.sha256(json.dumps(version.snapshot, sort_keys=True).encode()).hexdigest()
+    RecipeVersion.objects.bulk_update(versions, ["snapshot", "digest"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0043_product_oven_space_positive"),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_ingredient_fields, migrations.RunPython.noop),
+    ]
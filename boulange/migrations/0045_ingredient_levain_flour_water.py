@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0044_recipe_version_ingredients"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ingredient",
+            name="levain_flour",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name="+", to="boulange.ingredient"),
+        ),
+        migrations.AddField(
+            model_name="ingredient",
+            name="levain_water",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name="+", to="boulange.ingredient"),
+        ),
+    ]
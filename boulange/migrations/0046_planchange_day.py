@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boulange", "0045_ingredient_levain_flour_water"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="planchange",
+            name="day",
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -1,15 +1,55 @@
+import copy
+import hashlib
+import json
+import logging
+import operator
 import uuid
 from collections import defaultdict
-from datetime import date, timedelta
-from decimal import Decimal
+from collections.abc import Mapping
+from datetime import date, time, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from functools import partial, reduce
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models import (
+    Case,
+    Exists,
+    ExpressionWrapper,
+    F,
+    Max,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce, Round
+from django.dispatch import Signal
 from django.utils import timezone
 
-from boulange import SPECIAL_UNITS_WEIGHTS
+from .units import (
+    BASE_UNITS,
+    COEF_SCALE,
+    MG_PER_G,
+    MICROCENTS,
+    get_base_quantity,
+    get_scaled_coef,
+    get_unit_price,
+    get_unit_weight,
+    validate_coef,
+)
+
+logger = logging.getLogger(__name__)
 
 TVA = 5.5
+# order and delivery date totals computed in SQL, then rounded to cents
+TOTAL_FIELD = models.DecimalField(max_digits=14, decimal_places=8)
+CENTS_FIELD = models.DecimalField(max_digits=12, decimal_places=2)
 
 # How far ahead customers are allowed to place orders. Delivery dates must always
 # exist at least this far out (mirrored by views._get_start_end_command_period).
@@ -29,6 +69,43 @@ class Settings(models.Model):
         verbose_name = "Paramètre"
 
 
+# name -> value of every Settings row, emptied by clear_catalogue when one changes
+_settings = None
+
+
+def get_setting(name, default):
+    """Value of the Settings row name, cast to the type of default: int, float,
+    bool, time ("HH:MM") or tuple of floats ("1:2:2"). All the settings are read
+    at once on first use (1 query) and kept until one of them is saved or
+    deleted, by any process (see sync_catalogue). default is returned when the
+    row is missing or can't be cast."""
+    global _settings
+    if _settings is None:
+        _settings = dict(Settings.objects.values_list("name", "value"))
+    value = _settings.get(name)
+    if value is None:
+        return default
+    try:
+        if isinstance(default, bool):
+            return value.strip().lower() in ("1", "true", "oui")
+        if isinstance(default, time):
+            return time.fromisoformat(value.strip())
+        if isinstance(default, tuple):
+            values = tuple(float(v) for v in value.split(":"))
+            if len(values) != len(default):
+                raise ValueError(value)
+            return values
+        return type(default)(value)
+    except ValueError:
+        logger.warning("setting %s: can't read %r, using %r", name, value, default)
+        return default
+
+
+def clear_settings():
+    global _settings
+    _settings = None
+
+
 class Ingredient(models.Model):
     name = models.CharField(max_length=200)
     unit = models.CharField(max_length=10)
@@ -37,24 +114,95 @@ class Ingredient(models.Model):
     # qty of water needed is ing weight * coef
     soaking_coef = models.FloatField(default=1)
     decimal_round = models.BooleanField(default=True)
+    # levains made here are bought as the flour and water they are fed with, see forecast
+    levain_flour = models.ForeignKey("Ingredient", on_delete=models.PROTECT, null=True, blank=True, related_name="+")
+    levain_water = models.ForeignKey("Ingredient", on_delete=models.PROTECT, null=True, blank=True, related_name="+")
+    # per_unit_price and unit normalized by normalize(), see boulange.units
+    unit_price = models.BigIntegerField(default=0, editable=False, help_text="micro-cents per g, liter or unit")
+    unit_weight = models.IntegerField(null=True, editable=False, help_text="mg per thousandth of unit")
 
     def __str__(self):
         return self.name
 
+    def normalize(self):
+        self.unit_price = get_unit_price(self.unit, self.per_unit_price)
+        self.unit_weight = get_unit_weight(self.unit)
+
     class Meta:
         indexes = [models.Index(fields=["name"])]
         ordering = ["name"]
 
 
+def get_orig_product_depth():
+    "Length of the longest orig_product chain of the catalogue, 0 without any"
+    parents = dict(Product.objects.values_list("pk", "orig_product_id"))
+    depth = 0
+    for product_id in parents:
+        length = 0
+        # bounded, in case of a cycle saved without clean()
+        while parents.get(product_id) and length < len(parents):
+            product_id = parents[product_id]
+            length += 1
+        depth = max(depth, length)
+    return depth
+
+
+def _own_lines_total(path, field):
+    "Σ base_quantity × ingredient field over the own lines of the product at path, 0 without any"
+    lines = ProductLine.objects.filter(product=OuterRef(path)).values("product")
+    total = lines.annotate(total=Sum(F("base_quantity") * F(f"ingredient__{field}"))).values("total")
+    return Coalesce(Subquery(total), Value(0))
+
+
+class ProductQuerySet(models.QuerySet):
+    def with_costs(self):
+        """Annotate cost_per_unit (€), weight_per_unit (g, None when an ingredient
+        has no known weight) and margin (price - cost_per_unit), computed in SQL
+        from the normalized lines as CompiledRecipe does in Python.
+
+        The recipe of a product is its own lines plus coef times the recipe of
+        its orig_product: one subquery per level of the longest orig_product
+        chain, read first, so 2 queries whatever the size of the catalogue.
+        """
+        depth = get_orig_product_depth()
+        cost = weight = Value(0.0)
+        for level in reversed(range(depth + 1)):
+            prefix = "orig_product__" * level
+            # the integer thousandths CompiledRecipe applies (get_scaled_coef);
+            # past the end of a chain, the coef and the lines are NULL: nothing added
+            coef = Coalesce(Cast(Round(F(f"{prefix}coef") * COEF_SCALE), models.BigIntegerField()), Value(0)) / Value(float(COEF_SCALE))
+            cost = _own_lines_total(f"{prefix}pk", "unit_price") + coef * cost
+            weight = _own_lines_total(f"{prefix}pk", "unit_weight") + coef * weight
+        unknown_weight = ProductLine.objects.filter(
+            reduce(operator.or_, [Q(product=OuterRef("orig_product__" * level + "pk")) for level in range(depth + 1)]),
+            ingredient__unit_weight__isnull=True,
+        )
+        return self.annotate(
+            cost_per_unit=Cast(cost / Value(float(BASE_UNITS * MICROCENTS)) / F("nb_units"), models.DecimalField(max_digits=12, decimal_places=6)),
+            weight_per_unit=Case(
+                When(Exists(unknown_weight), then=Value(None)),
+                default=weight / Value(float(MG_PER_G)) / F("nb_units"),
+                output_field=models.FloatField(),
+            ),
+        ).annotate(margin=ExpressionWrapper(F("price") - F("cost_per_unit"), output_field=models.DecimalField(max_digits=12, decimal_places=6)))
+
+
+def validate_positive(value):
+    "MinValueValidator(0) lets 0 through"
+    if value <= 0:
+        raise ValidationError("Doit être strictement positif (%(value)s)", params={"value": value})
+
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     ref = models.CharField(max_length=20, unique=True)
     price = models.DecimalField(max_digits=5, decimal_places=2)
     active = models.BooleanField(default=True)
     # if orig_product is set we'll be using its ingredients with quantity * coef
+    # which can itself be made from another one, see resolve_recipe_lines
     orig_product = models.ForeignKey("Product", on_delete=models.PROTECT, null=True, blank=True)
     # when product_lines are defined in another product (orig_product)
-    coef = models.FloatField(default=1)
+    coef = models.FloatField(default=1, validators=[validate_coef])
     # recipe quantities are set for a given number of units
     nb_units = models.IntegerField(default=1)
     # baking is set as a multiple of nb_units - can't divide
@@ -62,6 +210,9 @@ class Product(models.Model):
     notes = models.TextField(blank=True, null=True)
     display_priority = models.IntegerField(default=0)
     is_bread = models.BooleanField(default=False)
+    # oven runs: products without a bake time are left out of them
+    bake_minutes = models.IntegerField(default=0)
+    oven_space = models.FloatField(default=1, validators=[MinValueValidator(0), validate_positive], help_text="room taken by one unit in an oven run")
     available_mondays = models.BooleanField(default=True)
     available_tuesdays = models.BooleanField(default=True)
     available_wednesdays = models.BooleanField(default=True)
@@ -70,9 +221,19 @@ class Product(models.Model):
     available_saturdays = models.BooleanField(default=True)
     available_sundays = models.BooleanField(default=True)
 
+    objects = ProductQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.name}/{self.ref}"
 
+    def clean(self):
+        product, seen = self.orig_product, {self.pk}
+        while product is not None:
+            if product.pk in seen:
+                raise ValidationError({"orig_product": "Ce produit est déjà dans la chaîne de ses produits d'origine"})
+            seen.add(product.pk)
+            product = product.orig_product
+
     def is_available_on_day(self, day_int):
         match day_int:
             case 0:
@@ -95,72 +256,35 @@ class Product(models.Model):
     def get_short_recipe_name(self):
         return f"{self.name.split(' (')[0]}/{self.ref}"
 
+    def get_compiled_recipe(self):
+        if self.pk is None:
+            get_compiled_recipes()
+            parent = _recipe_lines[self.orig_product_id] if self.orig_product_id else None
+            return CompiledRecipe(self, *_derive_recipe_lines(self, list(self.raw_ingredients.all()), parent))
+        return get_compiled_recipe(self.pk)
+
     @property
     def cost_price(self):
-        price = 0
-        for line in self.raw_ingredients.all():
-            unit_divisor = 1
-            if line.ingredient.unit == "g":
-                unit_divisor = 1000
-            price += Decimal(line.quantity) * line.ingredient.per_unit_price / unit_divisor
-        if self.orig_product:
-            for line in self.orig_product.raw_ingredients.all():
-                unit_divisor = 1
-                if line.ingredient.unit == "g":
-                    unit_divisor = 1000
-                price += Decimal(line.quantity) * Decimal(self.coef) * line.ingredient.per_unit_price / unit_divisor
-
-        return price / Decimal(self.nb_units)
+        return self.get_compiled_recipe().cost_price
 
     @property
     def weight(self):
-        weight = 0
-        for line in self.raw_ingredients.all():
-            if line.ingredient.unit == "g":
-                weight += line.quantity
-            elif line.ingredient.unit in SPECIAL_UNITS_WEIGHTS:
-                weight += line.quantity * SPECIAL_UNITS_WEIGHTS[line.ingredient.unit]
-            else:
-                raise ValueError(f"Can't add weight for {line.ingredient.name}!")
-        if self.orig_product:
-            for line in self.orig_product.raw_ingredients.all():
-                if line.ingredient.unit == "g":
-                    weight += line.quantity * self.coef
-                elif line.ingredient.unit in SPECIAL_UNITS_WEIGHTS:
-                    weight += line.quantity * SPECIAL_UNITS_WEIGHTS[line.ingredient.unit] * self.coef
-                else:
-                    raise ValueError(f"Can't add weight for {line.ingredient.name}!")
-        return weight / self.nb_units
+        return self.get_compiled_recipe().weight
 
     def get_processed_ingredients(self):
-        ingredients = {"direct": defaultdict(int), "base_product": defaultdict(int), "preparations": defaultdict(int)}
-        base_ingredients = []
-        if self.orig_product:
-            base_ingredients = self.orig_product.raw_ingredients.all()
-        for ingref, coef, inglist in [("direct", 1, self.raw_ingredients.all()), ("base_product", self.coef, base_ingredients)]:
-            for line in inglist:
-                qty = line.quantity * coef / self.nb_units
-                ingredients[ingref][line.ingredient] += qty
-                if line.ingredient.soaking_ingredient:
-                    soaking_coef = line.ingredient.soaking_coef
-                    ingredients[ingref][line.ingredient] += qty * soaking_coef
-                    ingredients[ingref][line.ingredient.soaking_ingredient] -= qty * soaking_coef
-                    ingredients["preparations"][line.ingredient] += qty
-                    ingredients["preparations"][line.ingredient.soaking_ingredient] += qty * soaking_coef
-                if line.ingredient.name.startswith("Levain"):
-                    ingredients["preparations"][line.ingredient] += qty
-        return ingredients
+        # copy, so callers can't alter the shared compiled recipe
+        return {ingref: defaultdict(int, ingredients) for ingref, ingredients in self.get_compiled_recipe().ingredients.items()}
 
     def get_batch_weight(self):
         "weight of orig product pâton, only for products that need a sub-batch"
-        if not self.orig_product:
-            return 0
-        weight = 0
-        for ing, ing_weight in self.get_processed_ingredients()["base_product"].items():
-            if ing.unit in SPECIAL_UNITS_WEIGHTS:
-                ing_weight *= SPECIAL_UNITS_WEIGHTS[ing.unit]
-            weight += ing_weight
-        return weight
+        return self.get_compiled_recipe().batch_weight
+
+    def get_baked_quantity(self, quantity):
+        "quantity actually baked for quantity ordered units"
+        if self.baked_by_batch and quantity % self.nb_units != 0:
+            # adjust quantities for products that need to be batch-baked
+            quantity += self.nb_units - (quantity % self.nb_units)
+        return quantity
 
     class Meta:
         indexes = [
@@ -175,11 +299,352 @@ class ProductLine(models.Model):
     product = models.ForeignKey(Product, related_name="raw_ingredients", on_delete=models.CASCADE)
     ingredient = models.ForeignKey(Ingredient, on_delete=models.PROTECT)
     quantity = models.FloatField()
+    # quantity in thousandths of the ingredient unit, set by normalize()
+    base_quantity = models.BigIntegerField(default=0, editable=False)
+
+    def normalize(self):
+        self.base_quantity = get_base_quantity(self.quantity)
 
     class Meta:
         ordering = ["ingredient__name"]
 
 
+class RecipeVersion(models.Model):
+    """Immutable snapshot of a product recipe: its expanded lines per unit, its
+    cost and weight, and the product and ingredient fields the planning reads
+    (see CompiledRecipe.get_snapshot). A new version exists once the compiled recipe
+    differs from every previous one; order lines point to the version in force
+    when they were placed, so that their plans and costs stay as they were.
+    """
+
+    PRODUCT_FIELDS = ("nb_units", "orig_product_id", "baked_by_batch", "is_bread")
+    INGREDIENT_FIELDS = ("name", "unit", "soaking_ingredient_id", "soaking_coef", "decimal_round", "unit_weight")
+    # the snapshots of the single level recipes had no base_product_id: it was orig_product_id
+    product = models.ForeignKey(Product, related_name="recipe_versions", on_delete=models.CASCADE)
+    digest = models.CharField(max_length=64)
+    snapshot = models.JSONField()
+    cost_price = models.DecimalField(max_digits=10, decimal_places=4)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.product_id} v{self.pk}"
+
+    class Meta:
+        unique_together = ("product", "digest")
+        verbose_name = "Version de recette"
+
+
+def _derive_recipe_lines(product, own_lines, parent):
+    """(direct, base, base product id) lines of a product, from its own lines and
+    the resolved lines of its orig_product (parent, None without one).
+
+    Lines come as (ProductLine, num, den) triples, the line being taken num/den
+    times: num is the product of the coefs of the chain in thousandths
+    (COEF_SCALE) and den the matching power of COEF_SCALE. The base dough is the
+    one of the root of the orig_product chain: what the products in between add
+    to it goes with the direct lines.
+    """
+    direct = [(line, 1, 1) for line in own_lines]
+    if parent is None:
+        return direct, [], None
+    parent_direct, parent_base, parent_base_id = parent
+    coef = get_scaled_coef(product.coef)
+    scaled_direct = [(line, num * coef, den * COEF_SCALE) for line, num, den in parent_direct]
+    if parent_base_id is None:
+        return direct, scaled_direct, product.orig_product_id
+    return direct + scaled_direct, [(line, num * coef, den * COEF_SCALE) for line, num, den in parent_base], parent_base_id
+
+
+def resolve_recipe_lines(products, lines):
+    """{product id: (direct, base, base product id) lines} of {id: Product} with
+    their {product id: [ProductLine]}, whatever the depth of the orig_product
+    chains: each product is derived once, from the memoized lines of its
+    orig_product, so the cost is linear in the number of products and lines.
+    Raises ValueError on a cycle."""
+    resolved = {}
+    for product_id in products:
+        chain = []
+        in_chain = set()
+        while product_id is not None and product_id not in resolved:
+            if product_id in in_chain:
+                raise ValueError(f"Cycle in the orig_product chain of {products[product_id]}")
+            chain.append(product_id)
+            in_chain.add(product_id)
+            product_id = products[product_id].orig_product_id
+        for product_id in reversed(chain):
+            product = products[product_id]
+            parent = resolved[product.orig_product_id] if product.orig_product_id else None
+            resolved[product_id] = _derive_recipe_lines(product, lines[product_id], parent)
+    return resolved
+
+
+class CompiledRecipe:
+    """A product recipe expanded once, per unit.
+
+    Holds the direct, base product and preparation (soaking, levain) quantities
+    along with the cost price and weight, so the planning code does not walk
+    raw_ingredients again for every order line. base_product_id is the product
+    whose dough this one is baked with (the root of its orig_product chain),
+    None for a product baked with its own dough.
+    """
+
+    __slots__ = ("product", "base_product_id", "ingredients", "line_quantities", "cost_price", "batch_weight", "_weight", "_weight_error", "_digest")
+
+    def __init__(self, product, direct_lines, base_lines, base_product_id=None):
+        "lines as given by resolve_recipe_lines"
+        self.product = product
+        self.base_product_id = base_product_id
+        ingredients = {"direct": defaultdict(int), "base_product": defaultdict(int), "preparations": defaultdict(int)}
+        # what the cost price is made of, before the soaking moves
+        line_quantities = defaultdict(int)
+        for ingref, inglist in [("direct", direct_lines), ("base_product", base_lines)]:
+            for line, num, den in inglist:
+                qty = line.base_quantity * num / (den * BASE_UNITS * product.nb_units)
+                line_quantities[line.ingredient] += qty
+                ingredients[ingref][line.ingredient] += qty
+                if line.ingredient.soaking_ingredient:
+                    soaking_coef = line.ingredient.soaking_coef
+                    ingredients[ingref][line.ingredient] += qty * soaking_coef
+                    ingredients[ingref][line.ingredient.soaking_ingredient] -= qty * soaking_coef
+                    ingredients["preparations"][line.ingredient] += qty
+                    ingredients["preparations"][line.ingredient.soaking_ingredient] += qty * soaking_coef
+                if line.ingredient.name.startswith("Levain"):
+                    ingredients["preparations"][line.ingredient] += qty
+        self.ingredients = {ingref: dict(values) for ingref, values in ingredients.items()}
+        self.line_quantities = dict(line_quantities)
+
+        # integer sums over the normalized quantities, all brought to the
+        # largest denominator (every den is a power of COEF_SCALE)
+        scale = max((den for _, _, den in direct_lines + base_lines), default=1)
+        cost = weight = batch_weight = 0
+        self._weight_error = None
+        for lines, is_base in [(direct_lines, False), (base_lines, True)]:
+            for line, num, den in lines:
+                quantity = line.base_quantity * num * (scale // den)
+                cost += quantity * line.ingredient.unit_price
+                if is_base:
+                    # weighed as BakeryBatch weighs the dough: 1 for a unit of unknown weight
+                    batch_weight += quantity * (line.ingredient.unit_weight or 1)
+                if line.ingredient.unit_weight is None:
+                    # only raised when the weight is actually asked for
+                    self._weight_error = f"Can't add weight for {line.ingredient.name}!"
+                    continue
+                weight += quantity * line.ingredient.unit_weight
+        self.cost_price = Decimal(cost) / (scale * BASE_UNITS * MICROCENTS * product.nb_units)
+        self._weight = weight / (scale * MG_PER_G * product.nb_units)
+        self.batch_weight = batch_weight / (scale * MG_PER_G * product.nb_units) if base_product_id else 0
+        self._digest = None
+
+    @classmethod
+    def from_snapshot(cls, product, snapshot):
+        "Recipe of a RecipeVersion snapshot, product being the current Product it is a version of"
+        recipe = cls.__new__(cls)
+        recipe.product = copy.copy(product)
+        for field in RecipeVersion.PRODUCT_FIELDS:
+            setattr(recipe.product, field, snapshot[field])
+        recipe.base_product_id = snapshot.get("base_product_id", snapshot["orig_product_id"])
+        ingredients = _get_snapshot_ingredients(snapshot)
+        recipe.ingredients = {ingref: {ingredients[int(ingredient_id)]: qty for ingredient_id, qty in values.items()} for ingref, values in snapshot["ingredients"].items()}
+        # not kept by the versions: only the recipe matrix, of the current recipes, uses it
+        recipe.line_quantities = None
+        recipe.cost_price = Decimal(snapshot["cost_price"])
+        recipe.batch_weight = snapshot["batch_weight"]
+        recipe._weight = snapshot["weight"]
+        recipe._weight_error = snapshot["weight_error"]
+        recipe._digest = None
+        return recipe
+
+    def get_snapshot(self):
+        "What a RecipeVersion keeps of this recipe, as JSON"
+        snapshot = {field: getattr(self.product, field) for field in RecipeVersion.PRODUCT_FIELDS}
+        snapshot.update(
+            base_product_id=self.base_product_id,
+            ingredients={ingref: {str(ingredient.pk): qty for ingredient, qty in values.items()} for ingref, values in self.ingredients.items()},
+            ingredient_fields={str(ingredient.pk): {field: getattr(ingredient, field) for field in RecipeVersion.INGREDIENT_FIELDS} for values in self.ingredients.values() for ingredient in values},
+            cost_price=str(self.cost_price),
+            batch_weight=self.batch_weight,
+            weight=self._weight,
+            weight_error=self._weight_error,
+        )
+        return snapshot
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(json.dumps(self.get_snapshot(), sort_keys=True).encode()).hexdigest()
+        return self._digest
+
+    @property
+    def weight(self):
+        if self._weight_error:
+            raise ValueError(self._weight_error)
+        return self._weight
+
+
+def _get_snapshot_ingredients(snapshot):
+    """{ingredient id: Ingredient} of a RecipeVersion snapshot: unsaved copies of
+    the fields it kept, so that an ingredient edited or deleted since leaves the
+    recipe as it was. An ingredient it has no fields of is the current one, or a
+    placeholder once deleted."""
+    kept = snapshot.get("ingredient_fields", {})
+    ingredients = {}
+    for ingredient_id in {int(pk) for values in snapshot["ingredients"].values() for pk in values}:
+        if str(ingredient_id) in kept:
+            ingredients[ingredient_id] = Ingredient(pk=ingredient_id, **kept[str(ingredient_id)])
+        elif ingredient_id in _compiled_ingredients:
+            ingredients[ingredient_id] = _compiled_ingredients[ingredient_id]
+        else:
+            logger.warning("Ingredient %s of a recipe version no longer exists", ingredient_id)
+            ingredients[ingredient_id] = Ingredient(pk=ingredient_id, name=f"Ingrédient supprimé ({ingredient_id})", unit="g", unit_weight=get_unit_weight("g"))
+    for ingredient in ingredients.values():
+        if str(ingredient.pk) in kept and ingredient.soaking_ingredient_id in ingredients:
+            ingredient.soaking_ingredient = ingredients[ingredient.soaking_ingredient_id]
+    return ingredients
+
+
+# product id -> CompiledRecipe, emptied by clear_catalogue on any recipe change
+_compiled_recipes = {}
+# ingredient id -> Ingredient, for every ingredient used by a compiled recipe
+_compiled_ingredients = {}
+# product id -> its lines as resolved by resolve_recipe_lines
+_recipe_lines = {}
+# RecipeVersion id -> CompiledRecipe, the current one of its product when they match
+_compiled_versions = {}
+# (product id, recipe digest) -> RecipeVersion id
+_current_versions = {}
+
+
+def get_compiled_recipes():
+    """Compile the whole catalogue on first use (2 queries) and keep it until a
+    Product, ProductLine or Ingredient is saved or deleted, by any process (see
+    sync_catalogue)."""
+    if not _compiled_recipes:
+        products = {product.pk: product for product in Product.objects.all()}
+        lines = defaultdict(list)
+        for line in ProductLine.objects.select_related("ingredient__soaking_ingredient"):
+            lines[line.product_id].append(line)
+        for product in products.values():
+            if product.orig_product_id:
+                product.orig_product = products[product.orig_product_id]
+        resolved = resolve_recipe_lines(products, lines)
+        compiled = {product_id: CompiledRecipe(products[product_id], *product_lines) for product_id, product_lines in resolved.items()}
+        _recipe_lines.update(resolved)
+        for recipe in compiled.values():
+            for ingredients in recipe.ingredients.values():
+                for ingredient in ingredients:
+                    _compiled_ingredients.setdefault(ingredient.pk, ingredient)
+        _compiled_recipes.update(compiled)
+    return _compiled_recipes
+
+
+def get_compiled_recipe(product_id):
+    recipe = get_compiled_recipes().get(product_id)
+    if recipe is None:
+        # created without going through save() signals (bulk_create, another process...)
+        clear_compiled_recipes()
+        recipe = get_compiled_recipes()[product_id]
+    return recipe
+
+
+def get_compiled_product(product_id):
+    return get_compiled_recipe(product_id).product
+
+
+def get_compiled_ingredient(ingredient_id):
+    get_compiled_recipes()
+    return _compiled_ingredients[ingredient_id]
+
+
+def get_current_recipe_version(product_id):
+    """Id of the RecipeVersion of the current recipe of a product, created on its
+    first use. Looked up by the digest of the compiled recipe, itself in sync
+    with the catalogue of every process (see sync_catalogue)."""
+    recipe = get_compiled_recipe(product_id)
+    version_id = _current_versions.get((product_id, recipe.digest))
+    if version_id is None:
+        version, _ = RecipeVersion.objects.get_or_create(
+            product_id=product_id,
+            digest=recipe.digest,
+            defaults={"snapshot": recipe.get_snapshot(), "cost_price": recipe.cost_price},
+        )
+        version_id = version.pk
+        # not before it is there for good: a rolled back id is given again
+        transaction.on_commit(partial(_current_versions.setdefault, (product_id, recipe.digest), version_id))
+    return version_id
+
+
+def get_compiled_versions(version_ids):
+    """{RecipeVersion id: CompiledRecipe}, in one query for the versions not seen
+    yet. A version of the current recipe of its product gets the very same
+    CompiledRecipe, the older ones are rebuilt from their snapshot."""
+    compiled = {pk: _compiled_versions[pk] for pk in version_ids if pk in _compiled_versions}
+    missing = set(version_ids) - compiled.keys()
+    if missing:
+        versions = RecipeVersion.objects.in_bulk(missing)
+        get_compiled_recipes()
+        # ingredients no recipe uses anymore
+        ingredient_ids = {int(pk) for version in versions.values() for values in version.snapshot["ingredients"].values() for pk in values} - _compiled_ingredients.keys()
+        if ingredient_ids:
+            _compiled_ingredients.update(Ingredient.objects.select_related("soaking_ingredient").in_bulk(ingredient_ids))
+        for pk, version in versions.items():
+            current = get_compiled_recipe(version.product_id)
+            compiled[pk] = current if current.digest == version.digest else CompiledRecipe.from_snapshot(current.product, version.snapshot)
+            # the deleted ones are read by id as the snapshot kept them
+            for values in compiled[pk].ingredients.values():
+                for ingredient in values:
+                    _compiled_ingredients.setdefault(ingredient.pk, ingredient)
+        # see get_current_recipe_version
+        transaction.on_commit(partial(_compiled_versions.update, {pk: compiled[pk] for pk in versions}))
+    return {pk: compiled[pk] for pk in version_ids}
+
+
+def clear_compiled_recipes():
+    _compiled_recipes.clear()
+    _compiled_ingredients.clear()
+    _recipe_lines.clear()
+    _compiled_versions.clear()
+    _current_versions.clear()
+
+
+# PlanChange id the process caches of the catalogue were emptied at, None when
+# they were emptied by a change of this process not committed yet
+_catalogue_version = None
+# sent when the process caches of the catalogue are emptied, for those of the
+# other modules (see boulange.signals)
+catalogue_cleared = Signal()
+
+
+def get_catalogue_version():
+    "Data version of what does not depend on the orders (products, recipes, settings, schedules)"
+    return PlanChange.objects.filter(delivery_date__isnull=True, day__isnull=True).aggregate(version=Max("pk"))["version"] or 0
+
+
+def clear_catalogue():
+    """Empty the process caches of the catalogue, after a change made by this
+    process: they are emptied again by the next sync_catalogue, once the change
+    is committed."""
+    global _catalogue_version
+    clear_compiled_recipes()
+    clear_settings()
+    catalogue_cleared.send(sender=None)
+    _catalogue_version = None
+
+
+def sync_catalogue(version=None):
+    """Empty the process caches of the catalogue if it changed since they were
+    last emptied, in this process or another one: each gunicorn worker has its
+    own caches, and a change only empties those of the worker that saved it.
+    version is the current get_catalogue_version(), read (1 query) when not
+    given. Called at the start of each request (see boulange.signals) and before
+    a plan is stored in the shared "plans" cache."""
+    global _catalogue_version
+    if version is None:
+        version = get_catalogue_version()
+    if version != _catalogue_version:
+        clear_catalogue()
+        _catalogue_version = version
+
+
 class Customer(AbstractUser):
     display_name = models.CharField(max_length=200, unique=True)
     is_professional = models.BooleanField(default=False)
@@ -208,11 +673,10 @@ class WeeklyDelivery(models.Model):
     # - public_delivery_point False + attaché un un customer pro (accessible seulement par lui)
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
     active = models.BooleanField(default=True)
-    BATCH_TARGET = {
-        "SAME_DAY": "same day",
-        "PREVIOUS_DAY": "previous day",
-    }
-    batch_target = models.CharField(max_length=20, choices=BATCH_TARGET, default="SAME_DAY")
+    # days between baking and delivery (0: baked on the delivery day, 3: on Friday for a Monday)
+    bakery_lead_days = models.PositiveSmallIntegerField(default=0)
+    # days between the preparations (levain, soaking) and baking
+    preparation_lead_days = models.PositiveSmallIntegerField(default=1)
     public_delivery_point = models.BooleanField(default=True)
     online_payment = models.BooleanField(default=True)
     DAY_OF_WEEK = {
@@ -288,12 +752,38 @@ class WeeklyDelivery(models.Model):
         verbose_name_plural = "Livraisons hebdo"
 
 
+def _round_cents(total):
+    "an order or delivery date total as _orders_total rounds it"
+    return Decimal(total).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def _orders_total(order=""):
+    """Sum of the line prices of the orders found at the order prefix ("" from
+    an Order, "order__" from a DeliveryDate), 0 without any: the frozen line
+    totals, and for cart lines in SQL what OrderLine.get_current_price does.
+    Rounded to cents in SQL: SQLite computes the decimals as floats."""
+    line, customer = f"{order}lines__", f"{order}customer__"
+    price = F(f"{line}product__price") * F(f"{line}quantity")
+    pro_rate = (1 - Value(Decimal(str(TVA)) / 100)) * (1 - Cast(f"{customer}pro_discount_percentage", TOTAL_FIELD) / 100)
+    current = Case(When(**{f"{customer}is_professional": True}, then=price * pro_rate), default=price, output_field=TOTAL_FIELD)
+    total = Coalesce(Sum(Coalesce(f"{line}total", current)), Value(Decimal(0)), output_field=TOTAL_FIELD)
+    return Round(total, 2, output_field=CENTS_FIELD)
+
+
+class DeliveryDateQuerySet(models.QuerySet):
+    def with_totals(self):
+        "Annotate orders_total, the price of all the orders of each date (see get_total)"
+        return self.annotate(orders_total=_orders_total("order__"))
+
+
 class DeliveryDate(models.Model):
     weekly_delivery = models.ForeignKey(WeeklyDelivery, on_delete=models.CASCADE, null=True)
     date = models.DateField()
     active = models.BooleanField(default=True)
     notes = models.TextField(blank=True, null=True)
 
+    objects = DeliveryDateQuerySet.as_manager()
+
     def __str__(self):
         inactive = ""
         if not self.active:
@@ -305,149 +795,372 @@ class DeliveryDate(models.Model):
         verbose_name = "Date de livraison"
         verbose_name_plural = "Dates de livraison"
         unique_together = ("weekly_delivery", "date")
+        # the planning window: active dates between two days
+        indexes = [models.Index(fields=["date", "active"])]
 
     def get_total(self):
+        if hasattr(self, "orders_total"):
+            return self.orders_total
         total = 0
         for order in self.order_set.all():
-            total += order.total_price
-        return total
+            for line in order.lines.all():
+                total += line.get_price()
+        return _round_cents(total)
 
     def duplicate_commands_from(self, original_delivery_date):
         for order in original_delivery_date.order_set.all():
             order.duplicate_to_delivery_date(self)
 
 
-class DeliveryBatch(dict):
+class IdMapping(Mapping):
+    """Read-only view of an {id: value} dict, keyed by model instances.
+
+    Plans only hold ids: the instances are looked up with resolve(id) when the
+    view is iterated, i.e. when a template (or a test) reads the plan.
+    """
+
+    __slots__ = ("data", "resolve")
+
+    def __init__(self, data, resolve):
+        self.data = data
+        self.resolve = resolve
+
+    def __getitem__(self, key):
+        return self.data[getattr(key, "pk", key)]
+
+    def __contains__(self, key):
+        return getattr(key, "pk", key) in self.data
+
+    def __iter__(self):
+        return map(self.resolve, self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.data!r})"
+
+
+def _by_display_priority(values, get_product=get_compiled_product):
+    "Copy of a {product id: value} dict, highest display priority first"
+    return dict(sorted(values.items(), key=lambda item: get_product(item[0]).display_priority, reverse=True))
+
+
+class DeliveryBatch(Mapping):
+    "{delivery date id: {product id: quantity}}, read as {DeliveryDate: {Product: quantity}}"
+
+    __slots__ = ("lines", "delivery_dates", "products")
+
+    def __init__(self):
+        self.lines = {}
+        # delivery date id -> DeliveryDate, set by whoever fills the batch
+        self.delivery_dates = {}
+        # product id -> Product, set to spare compiling the catalogue, see get_product
+        self.products = {}
+
     def add_line(self, order_line):
-        dd = order_line.order.delivery_date
-        if dd not in self:
-            self[dd] = {}
-        if order_line.product not in self[dd]:
-            self[dd][order_line.product] = 0
-        self[dd][order_line.product] += order_line.quantity
+        delivery_date = order_line.order.delivery_date
+        self.delivery_dates[delivery_date.pk] = delivery_date
+        self.add(delivery_date.pk, order_line.product_id, order_line.quantity)
+
+    def add(self, delivery_date_id, product_id, quantity):
+        lines = self.lines.setdefault(delivery_date_id, {})
+        lines[product_id] = lines.get(product_id, 0) + quantity
+
+    def get_product(self, product_id):
+        product = self.products.get(product_id)
+        return product if product is not None else get_compiled_product(product_id)
+
+    def finalize(self, engine=None):
+        for delivery_date_id, lines in self.lines.items():
+            self.lines[delivery_date_id] = _by_display_priority(lines, self.get_product)
+
+    def __getitem__(self, delivery_date):
+        return IdMapping(self.lines[getattr(delivery_date, "pk", delivery_date)], self.get_product)
+
+    def __iter__(self):
+        return map(self.delivery_dates.__getitem__, self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+
+class BakeryRecipe(Mapping):
+    "Dough of a base product: {ingredient id: quantity}, its division in {product id: quantity} and its weight"
+
+    __slots__ = ("ingredients", "division", "weight")
+    KEYS = ("ingredients", "division", "weight")
+
+    def __init__(self):
+        self.ingredients = {}
+        self.division = {}
+        self.weight = 0
+
+    def __getitem__(self, key):
+        if key == "ingredients":
+            return IdMapping(self.ingredients, get_compiled_ingredient)
+        if key == "division":
+            return IdMapping(self.division, get_compiled_product)
+        if key == "weight":
+            return self.weight
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+
+class SubBatch(Mapping):
+    "Ingredients added to a part of a base product dough ({ingredient id: quantity}), read with its 'pâton' weight"
+
+    __slots__ = ("ingredients", "dough_weight")
+
+    def __init__(self, ingredients, dough_weight):
+        self.ingredients = ingredients
+        self.dough_weight = dough_weight
+
+    def __getitem__(self, key):
+        if key == "pâton":
+            return self.dough_weight
+        return self.ingredients[getattr(key, "pk", key)]
+
+    def __iter__(self):
+        yield from map(get_compiled_ingredient, self.ingredients)
+        yield "pâton"
+
+    def __len__(self):
+        return len(self.ingredients) + 1
 
-    def finalize(self):
-        for dd in self:
-            new_dict = {key: value for key, value in sorted(self[dd].items(), key=lambda items: items[0].display_priority, reverse=True)}
-            self[dd].clear()
-            self[dd].update(new_dict)
 
+class BakeryBatch(Mapping):
+    "{base product id: BakeryRecipe}, read as {Product: recipe}"
+
+    __slots__ = ("temp_products", "temp_versions", "recipes", "sub_batches_by_id", "nb_breads", "oven_runs")
 
-class BakeryBatch(dict):
     def __init__(self):
-        self.temp_products = defaultdict(int)
-        self.sub_batches = defaultdict(dict)
+        self.temp_products = {}
+        # RecipeVersion id -> quantity, for the lines placed with an older recipe
+        self.temp_versions = {}
+        self.recipes = {}
+        # base product id -> {product id: SubBatch}
+        self.sub_batches_by_id = {}
         self.nb_breads = 0
+        # [OvenRun], see boulange.oven
+        self.oven_runs = []
 
     def add_line(self, order_line):
-        self.temp_products[order_line.product] += order_line.quantity
+        self.add(order_line.product_id, order_line.quantity)
 
-    def finalize_product(self, product, line_quantity):
-        all_ingredients = product.get_processed_ingredients()
-        if product.baked_by_batch and line_quantity % product.nb_units != 0:
-            # adjust quantities for products that need to be batch-baked
-            line_quantity += product.nb_units - (line_quantity % product.nb_units)
-        if all_ingredients["direct"] and product.orig_product:
+    def add(self, product_id, quantity):
+        self.temp_products[product_id] = self.temp_products.get(product_id, 0) + quantity
+
+    def add_version(self, recipe_version_id, quantity):
+        self.temp_versions[recipe_version_id] = self.temp_versions.get(recipe_version_id, 0) + quantity
+
+    @property
+    def sub_batches(self):
+        return IdMapping({base_id: IdMapping(sub_batches, get_compiled_product) for base_id, sub_batches in self.sub_batches_by_id.items()}, get_compiled_product)
+
+    def finalize_product(self, product_id, line_quantity, recipe=None):
+        recipe = recipe or get_compiled_recipe(product_id)
+        product = recipe.product
+        all_ingredients = recipe.ingredients
+        line_quantity = product.get_baked_quantity(line_quantity)
+        if all_ingredients["direct"] and recipe.base_product_id:
             # need sub-batch
-            self.sub_batches[product.orig_product][product] = dict()
-            for ing, qty in all_ingredients["direct"].items():
-                self.sub_batches[product.orig_product][product][ing] = qty * product.nb_units
-            self.sub_batches[product.orig_product][product]["pâton"] = product.get_batch_weight() * line_quantity
+            sub_batches = self.sub_batches_by_id.setdefault(recipe.base_product_id, {})
+            if product.pk in sub_batches:
+                # also planned with another version: the recipe quantities shown are the ones of the first one
+                sub_batches[product.pk].dough_weight += recipe.batch_weight * line_quantity
+            else:
+                ingredients = {ing.pk: qty * product.nb_units for ing, qty in all_ingredients["direct"].items()}
+                sub_batches[product.pk] = SubBatch(ingredients, recipe.batch_weight * line_quantity)
         if product.is_bread:
             self.nb_breads += line_quantity
-        if product.orig_product:
-            base_product = product.orig_product
+        if recipe.base_product_id:
+            base_product_id = recipe.base_product_id
             ing_ref = "base_product"
         else:
-            base_product = product
+            base_product_id = product.pk
             ing_ref = "direct"
-        if base_product not in self:
-            self[base_product] = {}
-        if "ingredients" not in self[base_product]:
-            self[base_product]["ingredients"] = {}
-            self[base_product]["division"] = {}
-        if product not in self[base_product]["division"]:
-            self[base_product]["division"][product] = 0
-        self[base_product]["division"][product] += line_quantity
+        base_recipe = self.recipes.get(base_product_id)
+        if base_recipe is None:
+            base_recipe = self.recipes[base_product_id] = BakeryRecipe()
+        base_recipe.division[product.pk] = base_recipe.division.get(product.pk, 0) + line_quantity
         for ingredient, ing_qty in all_ingredients[ing_ref].items():
-            quantity = line_quantity * ing_qty
-            if ingredient not in self[base_product]["ingredients"]:
-                self[base_product]["ingredients"][ingredient] = 0
-            self[base_product]["ingredients"][ingredient] += quantity
-
-    def finalize(self):
-        for product, qty in self.temp_products.items():
-            self.finalize_product(product, qty)
-        for product in self:
-            self[product]["weight"] = 0
-            for ingredient in self[product]["ingredients"]:
-                ing_weight = self[product]["ingredients"][ingredient]
-                if ingredient.unit in SPECIAL_UNITS_WEIGHTS:
-                    ing_weight *= SPECIAL_UNITS_WEIGHTS[ingredient.unit]
-                self[product]["weight"] += ing_weight
-        new_dict = {key: value for key, value in sorted(self.items(), key=lambda items: items[0].display_priority, reverse=True)}
-        for base_product in new_dict:
-            new_dict[base_product]["division"] = {product: qty for product, qty in new_dict[base_product]["division"].items()}
-        self.clear()
-        self.update(new_dict)
-        self.sub_batches.default_factory = None
-
-
-class PreparationBatch(dict):
+            base_recipe.ingredients[ingredient.pk] = base_recipe.ingredients.get(ingredient.pk, 0) + line_quantity * ing_qty
+
+    def finalize(self, engine="python"):
+        if engine == "numpy":
+            from .recipe_matrix import expand_bakery_batch
+
+            expand_bakery_batch(self)
+        else:
+            for product_id, qty in self.temp_products.items():
+                self.finalize_product(product_id, qty)
+        # the matrices of the numpy engine only hold the current recipes
+        for version_id, recipe in get_compiled_versions(self.temp_versions).items():
+            self.finalize_product(recipe.product.pk, self.temp_versions[version_id], recipe)
+        if engine != "numpy" or self.temp_versions:
+            for recipe in self.recipes.values():
+                recipe.weight = 0
+                for ingredient_id, ing_weight in recipe.ingredients.items():
+                    # mg per thousandth of unit is also g per unit
+                    recipe.weight += ing_weight * (get_compiled_ingredient(ingredient_id).unit_weight or 1)
+        self.recipes = _by_display_priority(self.recipes)
+        from .oven import plan_oven_runs
+
+        plan_oven_runs(self)
+
+    def __getitem__(self, product):
+        return self.recipes[getattr(product, "pk", product)]
+
+    def __iter__(self):
+        return map(get_compiled_product, self.recipes)
+
+    def __len__(self):
+        return len(self.recipes)
+
+
+class Soaking(Mapping):
+    "Dry and soaking quantities of an ingredient to soak"
+
+    __slots__ = ("dry", "soaking_qty", "soaking_ingredient_id", "warning")
+
+    def __init__(self, soaking_ingredient_id):
+        self.dry = 0
+        self.soaking_qty = 0
+        self.soaking_ingredient_id = soaking_ingredient_id
+        self.warning = ""
+
+    def __getitem__(self, key):
+        if key == "soaking_ingredient":
+            return get_compiled_ingredient(self.soaking_ingredient_id)
+        if key in ("dry", "soaking_qty") or (key == "warning" and self.warning):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from ("dry", "soaking_qty", "soaking_ingredient")
+        if self.warning:
+            yield "warning"
+
+    def __len__(self):
+        return 4 if self.warning else 3
+
+
+class PreparationBatch(Mapping):
+    "levain ({ingredient id: quantity}) and trempage ({ingredient id: Soaking}), read keyed by Ingredient"
+
+    __slots__ = ("levain", "trempage", "temp_products", "temp_versions", "levain_builds")
+    KEYS = ("levain", "trempage")
+
     def __init__(self):
-        self["levain"] = {}
-        self["trempage"] = {}
-        self.temp_products = defaultdict(int)
+        self.levain = {}
+        self.trempage = {}
+        self.temp_products = {}
+        # RecipeVersion id -> quantity, for the lines placed with an older recipe
+        self.temp_versions = {}
+        # ingredient id -> [LevainStep], see boulange.levain
+        self.levain_builds = {}
 
     def add_line(self, order_line):
-        self.temp_products[order_line.product] += order_line.quantity
+        self.add(order_line.product_id, order_line.quantity)
 
-    def finalize_product(self, product, line_quantity):
-        if product.baked_by_batch and line_quantity % product.nb_units != 0:
-            # adjust quantities for products that need to be batch-baked
-            line_quantity += product.nb_units - (line_quantity % product.nb_units)
-        for ingredient, ing_qty in product.get_processed_ingredients()["preparations"].items():
+    def add(self, product_id, quantity):
+        self.temp_products[product_id] = self.temp_products.get(product_id, 0) + quantity
+
+    def add_version(self, recipe_version_id, quantity):
+        self.temp_versions[recipe_version_id] = self.temp_versions.get(recipe_version_id, 0) + quantity
+
+    def finalize_product(self, product_id, line_quantity, recipe=None):
+        recipe = recipe or get_compiled_recipe(product_id)
+        product = recipe.product
+        line_quantity = product.get_baked_quantity(line_quantity)
+        for ingredient, ing_qty in recipe.ingredients["preparations"].items():
             if ingredient.name.startswith("Levain"):
-                if ingredient not in self["levain"]:
-                    self["levain"][ingredient] = 0
-                self["levain"][ingredient] += ing_qty * line_quantity
+                self.levain[ingredient.pk] = self.levain.get(ingredient.pk, 0) + ing_qty * line_quantity
             elif ingredient.soaking_ingredient:
-                if ingredient not in self["trempage"]:
-                    self["trempage"][ingredient] = {"dry": 0, "soaking_qty": 0}
+                soaking = self.trempage.get(ingredient.pk)
+                if soaking is None:
+                    soaking = self.trempage[ingredient.pk] = Soaking(ingredient.soaking_ingredient.pk)
                 quantity = ing_qty * line_quantity
-                self["trempage"][ingredient]["dry"] += quantity
-                self["trempage"][ingredient]["soaking_qty"] += quantity * ingredient.soaking_coef
-                self["trempage"][ingredient]["soaking_ingredient"] = ingredient.soaking_ingredient
+                soaking.dry += quantity
+                soaking.soaking_qty += quantity * ingredient.soaking_coef
                 if ingredient.name == "Flocons de riz":
-                    self["trempage"][ingredient]["warning"] = "⚠ prévoir 10% de marge"
+                    soaking.warning = "⚠ prévoir 10% de marge"
+
+    def finalize(self, engine="python"):
+        if engine == "numpy":
+            from .recipe_matrix import expand_preparation_batch
+
+            expand_preparation_batch(self)
+        else:
+            for product_id, qty in self.temp_products.items():
+                self.finalize_product(product_id, qty)
+        for version_id, recipe in get_compiled_versions(self.temp_versions).items():
+            self.finalize_product(recipe.product.pk, self.temp_versions[version_id], recipe)
+        from .levain import plan_levain_builds
+
+        plan_levain_builds(self)
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return IdMapping(getattr(self, key), get_compiled_ingredient)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
 
-    def finalize(self):
-        for product, qty in self.temp_products.items():
-            self.finalize_product(product, qty)
+def get_planning_days(delivery_day, bakery_lead_days, preparation_lead_days):
+    "Delivery, bakery and preparation days of an order delivered on delivery_day"
+    bakery_day = delivery_day - timedelta(days=bakery_lead_days)
+    return delivery_day, bakery_day, bakery_day - timedelta(days=preparation_lead_days)
 
 
-class Actions(dict):
+class Actions(Mapping):
+    __slots__ = ("delivery", "bakery", "preparation")
+    KEYS = ("delivery", "bakery", "preparation")
+
     def __init__(self):
-        self["delivery"] = DeliveryBatch()
-        self["bakery"] = BakeryBatch()
-        self["preparation"] = PreparationBatch()
+        self.delivery = DeliveryBatch()
+        self.bakery = BakeryBatch()
+        self.preparation = PreparationBatch()
 
     def add_order_for_delivery(self, order):
         for line in order.lines.all():
-            self["delivery"].add_line(line)
+            self.delivery.add_line(line)
 
     def add_order_for_bakery(self, order):
         for line in order.lines.all():
-            self["bakery"].add_line(line)
+            self.bakery.add_line(line)
 
     def add_order_for_preparation(self, order):
         for line in order.lines.all():
-            self["preparation"].add_line(line)
+            self.preparation.add_line(line)
 
-    def finalize(self):
+    def finalize(self, engine=None):
         "To be called after all orders have been processed"
+        engine = engine or settings.BOULANGE_PLANNING_ENGINE
         for batch in self.values():
-            batch.finalize()
+            batch.finalize(engine)
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
 
 
 class Checkout(models.Model):
@@ -461,6 +1174,12 @@ class Checkout(models.Model):
         verbose_name = "Panier"
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        "Annotate lines_total, the price of each order (see total_price), in the same query"
+        return self.annotate(lines_total=_orders_total())
+
+
 class Order(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
     delivery_date = models.ForeignKey(DeliveryDate, on_delete=models.PROTECT)
@@ -468,28 +1187,63 @@ class Order(models.Model):
     validated = models.BooleanField(default=True)
     checkout = models.ForeignKey(Checkout, on_delete=models.SET_NULL, blank=True, null=True)
 
+    objects = OrderQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.customer}/{self.delivery_date}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super().from_db(db, field_names, values)
+        if "validated" in field_names and "checkout_id" in field_names:
+            # the lines are repriced by save only when this changes
+            order._loaded_priced = order.is_priced()
+        return order
+
+    def save(self, **kwargs):
+        adding = self._state.adding
+        super().save(**kwargs)
+        priced = self.is_priced()
+        if adding or priced == getattr(self, "_loaded_priced", None):
+            self._loaded_priced = priced
+            return
+        self._loaded_priced = priced
+        if priced:
+            self.freeze_prices()
+        else:
+            # back in the cart: priced again when validated or checked out
+            OrderLine.objects.filter(order=self, total__isnull=False).update(unit_price=None, discount=None, total=None)
+
+    def is_priced(self):
+        "prices of the lines frozen: the order is validated or being paid"
+        return self.validated or self.checkout_id is not None
+
+    def freeze_prices(self):
+        "Freeze the price of the lines that have none yet"
+        lines = list(self.lines.filter(total__isnull=True).select_related("product"))
+        for line in lines:
+            line.order = self
+            line.freeze_price()
+        OrderLine.objects.bulk_update(lines, ["unit_price", "discount", "total"])
+
     @property
     def total_price(self):
+        if hasattr(self, "lines_total"):
+            return self.lines_total
         total = 0
         for line in self.lines.all():
             total += line.get_price()
-        return total
+        return _round_cents(total)
 
     def get_actions(self, target_day, actions=None):
         if not actions:
             actions = Actions()
-        if self.delivery_date.date == target_day:
+        weekly_delivery = self.delivery_date.weekly_delivery
+        delivery_day, bakery_day, preparation_day = get_planning_days(self.delivery_date.date, weekly_delivery.bakery_lead_days, weekly_delivery.preparation_lead_days)
+        if target_day == delivery_day:
             actions.add_order_for_delivery(self)
-        if self.delivery_date.weekly_delivery.batch_target == "SAME_DAY":
-            bakery_day = self.delivery_date.date
-        elif self.delivery_date.weekly_delivery.batch_target == "PREVIOUS_DAY":
-            bakery_day = self.delivery_date.date - timedelta(days=1)
         if target_day == bakery_day:
             actions.add_order_for_bakery(self)
-        preparation_day = bakery_day - timedelta(days=1)
         if target_day == preparation_day:
             actions.add_order_for_preparation(self)
         return actions
@@ -511,17 +1265,163 @@ class OrderLine(models.Model):
     order = models.ForeignKey(Order, related_name="lines", on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     quantity = models.IntegerField()
+    # recipe in force when the line was placed, see RecipeVersion
+    recipe_version = models.ForeignKey(RecipeVersion, on_delete=models.PROTECT, null=True, blank=True, editable=False)
+    # prices when the order was validated or checked out, None in a cart, see Order.is_priced
+    unit_price = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True, editable=False)
+    discount = models.DecimalField(max_digits=9, decimal_places=8, null=True, blank=True, editable=False, help_text="part of the price taken off (TVA and pro discount)")
+    total = models.DecimalField(max_digits=14, decimal_places=8, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.quantity} {self.product.ref}"
 
-    def get_price(self):
-        total = self.product.price * self.quantity
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        line = super().from_db(db, field_names, values)
+        if {"order_id", "product_id", "quantity"} <= set(field_names):
+            # what the frozen prices were computed for, see save
+            line._loaded_priced_as = line._get_priced_as()
+        return line
+
+    def _get_priced_as(self):
+        return self.order_id, self.product_id, self.quantity
+
+    def save(self, **kwargs):
+        update_fields = set()
+        if self.recipe_version_id is None or get_compiled_versions([self.recipe_version_id])[self.recipe_version_id].product.pk != self.product_id:
+            self.recipe_version_id = get_current_recipe_version(self.product_id)
+            update_fields.add("recipe_version")
+        # a line placed or changed on a priced order gets the prices of now,
+        # other saves (notes, admin edits) keep the prices it was sold at
+        if self.total is None or getattr(self, "_loaded_priced_as", None) != self._get_priced_as():
+            if self.order.is_priced():
+                self.freeze_price()
+            else:
+                self.unit_price = self.discount = self.total = None
+            update_fields.update(["unit_price", "discount", "total"])
+        if "update_fields" in kwargs and kwargs["update_fields"] is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], *update_fields}
+        super().save(**kwargs)
+        self._loaded_priced_as = self._get_priced_as()
+
+    def get_cost(self):
+        "cost price of the line, with the recipe it was placed with"
+        recipe = get_compiled_versions([self.recipe_version_id])[self.recipe_version_id] if self.recipe_version_id else get_compiled_recipe(self.product_id)
+        return recipe.cost_price * self.quantity
+
+    def get_current_price(self):
+        "(unit price, discount, total) of the line at the current prices"
+        discount = Decimal(0)
         if self.order.customer.is_professional:
             tva_rate = Decimal(str(TVA)) / 100
             discount_rate = Decimal(str(self.order.customer.pro_discount_percentage)) / 100
-            total = (total - total * tva_rate) * (1 - discount_rate)
-        return total
+            discount = 1 - (1 - tva_rate) * (1 - discount_rate)
+        return self.product.price, discount, self.product.price * self.quantity * (1 - discount)
+
+    def freeze_price(self):
+        self.unit_price, self.discount, self.total = self.get_current_price()
+
+    def get_price(self):
+        if self.total is not None:
+            return self.total
+        return self.get_current_price()[2]
 
     class Meta:
         ordering = ["product__name"]
+
+
+class ProductionPlan(models.Model):
+    """Validated quantities of a product to deliver, bake or prepare on a day.
+
+    A materialized copy of the order totals, refreshed one delivery date at a
+    time from the order signals (see planning.refresh_production_plan). The
+    recipes are expanded when the plan is read, from the recipe version of the
+    order lines, so a recipe change needs no refresh.
+    """
+
+    KIND = {
+        "delivery": "livraison",
+        "bakery": "boulange",
+        "preparation": "préparation",
+    }
+    day = models.DateField()
+    kind = models.CharField(max_length=20, choices=KIND)
+    delivery_date = models.ForeignKey(DeliveryDate, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    recipe_version = models.ForeignKey(RecipeVersion, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.IntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["day", "kind"])]
+        unique_together = ("day", "kind", "delivery_date", "product", "recipe_version")
+        verbose_name = "Plan de production"
+
+
+class StaleProductionPlan(models.Model):
+    "Delivery dates whose ProductionPlan rows must be recomputed before being read"
+
+    delivery_date = models.OneToOneField(DeliveryDate, on_delete=models.CASCADE)
+
+
+class PlanChange(models.Model):
+    """Change feed of the plans: one row per delivery date whose orders changed,
+    per day a delivery date moved away from (day), or with neither when the
+    change affects every day (recipes, settings, planning window). A recipe
+    change (catalogue) no longer affects the days already past: their order
+    lines keep the recipe versions they were placed with.
+
+    The latest id of the rows relevant to a period is its data version.
+    """
+
+    delivery_date = models.ForeignKey(DeliveryDate, on_delete=models.SET_NULL, null=True, blank=True)
+    catalogue = models.BooleanField(default=False)
+    day = models.DateField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Changement de plan"
+
+
+class StockMovement(models.Model):
+    """Ledger of the ingredient stock: quantity is positive for what comes in,
+    negative for what is used, and balance is the running stock of the
+    ingredient once the movement is applied, in (day, id) order. A movement
+    entered for a past day rewrites the balances of the days after (see
+    stock.record_stock_movements).
+    """
+
+    KIND = {
+        "delivery": "livraison",
+        "consumption": "consommation",
+        "inventory": "inventaire",
+    }
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.PROTECT, related_name="stock_movements")
+    day = models.DateField()
+    kind = models.CharField(max_length=20, choices=KIND)
+    quantity = models.FloatField()
+    balance = models.FloatField(editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.ingredient}/{self.day}/{self.get_kind_display()}"
+
+    class Meta:
+        indexes = [models.Index(fields=["ingredient", "-day", "-id"]), models.Index(fields=["kind", "day"])]
+        constraints = [models.UniqueConstraint(fields=["ingredient", "day"], condition=Q(kind="consumption"), name="unique_daily_consumption")]
+        verbose_name = "Mouvement de stock"
+
+
+class PrintedPlan(models.Model):
+    """Snapshot of a printed section of the actions page: its quantities keyed by
+    line (see snapshots.get_plan_lines) and their digest, to tell what changed
+    since without keeping the rendered page."""
+
+    day = models.DateField()
+    section = models.CharField(max_length=20)
+    digest = models.CharField(max_length=64)
+    lines = models.JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["day", "section", "-id"])]
+        verbose_name = "Plan imprimé"
@@ -0,0 +1,82 @@
+"""Oven-load planning.
+
+The divided products of a BakeryBatch are packed into oven runs of
+settings.BOULANGE_OVEN_CAPACITY room. A run lasts as long as its bake time, so
+only products baked for the same time share a run. Within a bake time, the
+products are packed first-fit decreasing: the biggest units are placed first,
+as many as fit in the first run with room left. Products are moved as blocks of
+units, so the cost grows with products x runs and not with the number of units.
+"""
+
+from collections.abc import Mapping
+
+from django.conf import settings
+
+from .models import get_compiled_product
+
+# float room left below this is treated as no room
+EPSILON = 1e-9
+
+
+class OvenRun(Mapping):
+    "Units baked in one oven run ({product id: count}), read keyed by Product, with the run bake time and load"
+
+    __slots__ = ("minutes", "load", "products")
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.load = 0
+        self.products = {}
+
+    def put(self, product_id, count, space):
+        self.products[product_id] = self.products.get(product_id, 0) + count
+        self.load += count * space
+
+    def __getitem__(self, product):
+        return self.products[getattr(product, "pk", product)]
+
+    def __iter__(self):
+        return map(get_compiled_product, self.products)
+
+    def __len__(self):
+        return len(self.products)
+
+
+def pack_oven_runs(quantities, capacity=None):
+    "OvenRun list for {product id: units to bake}, longest bake times first"
+    capacity = capacity or settings.BOULANGE_OVEN_CAPACITY
+    by_minutes = {}
+    for product_id, count in quantities.items():
+        product = get_compiled_product(product_id)
+        # a unit taking no room cannot be packed: left out too, whatever the data says
+        if product.bake_minutes and count and product.oven_space > 0:
+            by_minutes.setdefault(product.bake_minutes, []).append((product.oven_space, product_id, count))
+    runs = []
+    for minutes in sorted(by_minutes, reverse=True):
+        minute_runs = []
+        for space, product_id, count in sorted(by_minutes[minutes], reverse=True):
+            for run in minute_runs:
+                fits = min(count, int((capacity - run.load + EPSILON) // space))
+                if fits > 0:
+                    run.put(product_id, fits, space)
+                    count -= fits
+                if not count:
+                    break
+            while count:
+                # a unit bigger than the oven still gets a run of its own
+                run = OvenRun(minutes)
+                fits = min(count, max(1, int((capacity + EPSILON) // space)))
+                run.put(product_id, fits, space)
+                count -= fits
+                minute_runs.append(run)
+        runs += minute_runs
+    return runs
+
+
+def plan_oven_runs(batch):
+    "Fill the oven_runs of a finalized BakeryBatch from its division"
+    quantities = {}
+    for recipe in batch.recipes.values():
+        for product_id, count in recipe.division.items():
+            quantities[product_id] = quantities.get(product_id, 0) + count
+    batch.oven_runs = pack_oven_runs(quantities)
@@ -0,0 +1,329 @@
+from datetime import date, timedelta
+from functools import partial
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum
+
+from .models import (
+    Actions,
+    DeliveryDate,
+    OrderLine,
+    PlanChange,
+    Product,
+    ProductionPlan,
+    StaleProductionPlan,
+    WeeklyDelivery,
+    get_compiled_recipe,
+    get_compiled_versions,
+    get_planning_days,
+    sync_catalogue,
+)
+from .singleflight import single_flight
+
+# longest period a range plan can cover
+MAX_RANGE_DAYS = 31
+# days before and after the displayed one in the actions page navigation,
+# built along with it
+NAV_DAYS = 5
+# printable sections of the actions page -> ProductionPlan.kind
+SECTIONS = {
+    "livraison": "delivery",
+    "boulange": "bakery",
+    "four": "bakery",
+    "preparations": "preparation",
+}
+
+
+# emptied by boulange.signals with the process caches of the catalogue: a
+# weekly delivery change moving it is recorded as an everyday change (see
+# sync_catalogue)
+_planning_window_days = None
+
+
+def get_planning_window_days():
+    """Most days between the preparations of an order and its delivery: the plan
+    of day D depends on the delivery dates from D to D + this window. Read on
+    first use (1 query) and kept until a weekly delivery is saved."""
+    global _planning_window_days
+    if _planning_window_days is None:
+        lead_days = WeeklyDelivery.objects.aggregate(days=Max(F("bakery_lead_days") + F("preparation_lead_days")))
+        _planning_window_days = lead_days["days"] or 0
+    return _planning_window_days
+
+
+def clear_planning_window_days():
+    global _planning_window_days
+    _planning_window_days = None
+
+
+def get_order_totals(start=None, end=None, delivery_date_ids=None, include_unvalidated=False):
+    """Validated quantities summed per (delivery date, lead days, product), in one
+    aggregate query over the order lines delivered between start and end (or on
+    the given delivery dates). include_unvalidated adds the orders of the carts
+    not paid yet."""
+    lines = OrderLine.objects.filter(order__delivery_date__active=True)
+    if not include_unvalidated:
+        lines = lines.filter(order__validated=True)
+    if start is not None:
+        lines = lines.filter(order__delivery_date__date__gte=start)
+    if end is not None:
+        lines = lines.filter(order__delivery_date__date__lte=end)
+    if delivery_date_ids is not None:
+        lines = lines.filter(order__delivery_date__in=delivery_date_ids)
+    return list(
+        lines.values(
+            "product",
+            "recipe_version",
+            delivery_date_id=F("order__delivery_date"),
+            date=F("order__delivery_date__date"),
+            bakery_lead_days=F("order__delivery_date__weekly_delivery__bakery_lead_days"),
+            preparation_lead_days=F("order__delivery_date__weekly_delivery__preparation_lead_days"),
+        )
+        .annotate(quantity=Sum("quantity"))
+        .order_by("order__delivery_date__date", "order__delivery_date__weekly_delivery", "product__name")
+    )
+
+
+def compute_plan_rows(totals):
+    "Unsaved ProductionPlan rows: each total is delivered, baked and prepared on its own day"
+    for total in totals:
+        days = get_planning_days(total["date"], total["bakery_lead_days"], total["preparation_lead_days"])
+        for kind, day in zip(ProductionPlan.KIND, days):
+            yield ProductionPlan(
+                day=day,
+                kind=kind,
+                delivery_date_id=total["delivery_date_id"],
+                product_id=total["product"],
+                recipe_version_id=total["recipe_version"],
+                quantity=total["quantity"],
+            )
+
+
+def refresh_production_plan(delivery_date_ids):
+    "Recompute the ProductionPlan rows of the given delivery dates"
+    delivery_date_ids = list(delivery_date_ids)
+    pending = _get_pending_refresh()
+    if pending is not None:
+        # up to date again: flagged anew by their next change
+        pending.difference_update(delivery_date_ids)
+    if not delivery_date_ids:
+        return
+    with transaction.atomic():
+        ProductionPlan.objects.filter(delivery_date__in=delivery_date_ids).delete()
+        ProductionPlan.objects.bulk_create(compute_plan_rows(get_order_totals(delivery_date_ids=delivery_date_ids)))
+        StaleProductionPlan.objects.filter(delivery_date__in=delivery_date_ids).delete()
+
+
+def record_plan_changes(delivery_date_ids=None, catalogue=False, days=None):
+    """Append to the change feed, for the given delivery dates, the given days (a
+    delivery date moved away from them) or (neither) for every day, catalogue for
+    a recipe change"""
+    if delivery_date_ids is None and days is None:
+        PlanChange.objects.create(catalogue=catalogue)
+    else:
+        PlanChange.objects.bulk_create([PlanChange(delivery_date_id=pk) for pk in delivery_date_ids or ()] + [PlanChange(day=day) for day in days or ()])
+
+
+def prune_plan_changes():
+    """Delete the rows of the change feed no data version depends on anymore: a
+    version is the latest id of some rows, so only the latest row of each
+    delivery date, of each day, of the catalogue changes and of the other
+    everyday changes is kept. Returns the number of rows deleted."""
+    latest = PlanChange.objects.values("delivery_date", "day", "catalogue").annotate(latest=Max("pk")).values("latest").order_by()
+    deleted, _ = PlanChange.objects.exclude(pk__in=latest).delete()
+    return deleted
+
+
+def get_delivery_version(start, end, catalogue=True):
+    """(data version, last modification) of the orders delivered from start to
+    end, from an aggregate over the change feed, recipe changes left out unless
+    catalogue. The version is 0 before any change."""
+    window = Q(delivery_date__date__gte=start, delivery_date__date__lte=end) | Q(day__gte=start, day__lte=end)
+    everyday = Q(delivery_date__isnull=True, day__isnull=True) if catalogue else Q(delivery_date__isnull=True, day__isnull=True, catalogue=False)
+    changes = PlanChange.objects.filter(everyday | window)
+    latest = changes.aggregate(version=Max("pk"), modified=Max("created"))
+    return latest["version"] or 0, latest["modified"]
+
+
+def get_plan_version(start, end):
+    """(data version, last modification) of the plans of start to end days. The
+    plans of past days are read with the recipe versions of their order lines:
+    the recipe changes do not count for them."""
+    return get_delivery_version(start, end + timedelta(days=get_planning_window_days()), catalogue=end >= date.today())
+
+
+def get_plan_versions(start, end):
+    """Data version of each day from start to end, from a single pass over the
+    change feed: a day depends on the delivery dates of its planning window."""
+    window_days = get_planning_window_days()
+    window_end = end + timedelta(days=window_days)
+    changes = (
+        PlanChange.objects.filter(Q(delivery_date__isnull=True, day__isnull=True) | Q(delivery_date__date__gte=start, delivery_date__date__lte=window_end) | Q(day__gte=start, day__lte=window_end))
+        .values("delivery_date__date", "day", "catalogue")
+        .annotate(version=Max("pk"))
+        .order_by()
+    )
+    by_date = {}
+    everyday = catalogue = 0
+    for change in changes:
+        changed = change["delivery_date__date"] or change["day"]
+        if changed is not None:
+            by_date[changed] = max(by_date.get(changed, 0), change["version"])
+        elif change["catalogue"]:
+            catalogue = change["version"]
+        else:
+            everyday = change["version"]
+    today = date.today()
+    versions = {}
+    day = start
+    while day <= end:
+        # see get_plan_version
+        versions[day] = max([everyday, catalogue if day >= today else 0] + [by_date.get(day + timedelta(days=i), 0) for i in range(window_days + 1)])
+        day += timedelta(days=1)
+    return versions
+
+
+def mark_production_plan_stale(delivery_date_ids):
+    """Flag delivery dates whose orders changed and refresh them once the current
+    transaction commits. The flag stays in place if the refresh never happens, so
+    the next read still sees up to date rows.
+
+    A transaction saving many order lines flags each delivery date once and
+    refreshes them all in a single callback: the dates already pending are kept
+    on the connection, along with that callback, as long as it is registered
+    (a rollback drops it)."""
+    delivery_date_ids = {pk for pk in delivery_date_ids if pk is not None}
+    pending = _get_pending_refresh()
+    if pending is not None:
+        delivery_date_ids -= pending
+    if not delivery_date_ids:
+        return
+    StaleProductionPlan.objects.bulk_create([StaleProductionPlan(delivery_date_id=pk) for pk in delivery_date_ids], ignore_conflicts=True)
+    record_plan_changes(delivery_date_ids)
+    if pending is None:
+        connection = transaction.get_connection()
+        connection.production_plan_refresh = partial(refresh_production_plan, delivery_date_ids)
+        transaction.on_commit(connection.production_plan_refresh)
+    else:
+        pending.update(delivery_date_ids)
+
+
+def _get_pending_refresh():
+    "Delivery dates flagged by mark_production_plan_stale in the current transaction and not refreshed yet, None when there are none"
+    connection = transaction.get_connection()
+    refresh = getattr(connection, "production_plan_refresh", None)
+    if refresh is not None and refresh.args[0] and any(func is refresh for _, func, _ in connection.run_on_commit):
+        return refresh.args[0]
+    return None
+
+
+def refresh_stale_production_plan(start, end):
+    "Refresh the flagged delivery dates that can have actions between start and end"
+    stale = list(
+        StaleProductionPlan.objects.filter(delivery_date__date__gte=start).filter(delivery_date__date__lte=end + timedelta(days=get_planning_window_days())).values_list("delivery_date", flat=True)
+    )
+    if stale:
+        refresh_production_plan(stale)
+
+
+def build_range_actions(start, end, engine=None, materialized=True, kinds=None):
+    """Actions of every day from start to end, from a single pass over the plan rows.
+
+    The rows are read from the ProductionPlan table, or recomputed from the order
+    totals when materialized is False. Each row is assigned to its delivery,
+    bakery or preparation batch, so the cost grows with the number of totals and
+    not with days x orders. Days with nothing to do map to None. Before today,
+    the rows are expanded with the recipe version of their order lines (see
+    RecipeVersion) rather than with the current recipes.
+
+    kinds restricts the plan to some of the batches: the other ones are left
+    empty and cost nothing (no recipe expansion, no delivery date lookup).
+    """
+    kinds = list(kinds or ProductionPlan.KIND)
+    if materialized:
+        refresh_stale_production_plan(start, end)
+        rows = list(ProductionPlan.objects.filter(day__gte=start).filter(day__lte=end).filter(kind__in=kinds).order_by("delivery_date__date", "delivery_date__weekly_delivery", "product__name"))
+    else:
+        totals = get_order_totals(start, end + timedelta(days=get_planning_window_days()))
+        rows = [row for row in compute_plan_rows(totals) if start <= row.day <= end and row.kind in kinds]
+    delivery_dates = DeliveryDate.objects.select_related("weekly_delivery__customer").in_bulk({row.delivery_date_id for row in rows if row.kind == "delivery"})
+    # the other batches compile the whole catalogue: a delivery sheet alone reads its products
+    products = Product.objects.in_bulk({row.product_id for row in rows}) if kinds == ["delivery"] else {}
+    # what was done on the past days does not move with the recipes anymore
+    today = date.today()
+    versions = get_compiled_versions({row.recipe_version_id for row in rows if row.kind != "delivery" and row.day < today and row.recipe_version_id is not None})
+    plans = {}
+    for row in rows:
+        batch = plans.setdefault(row.day, Actions())[row.kind]
+        if row.kind == "delivery":
+            batch.add(row.delivery_date_id, row.product_id, row.quantity)
+        elif row.day < today and row.recipe_version_id in versions and versions[row.recipe_version_id] is not get_compiled_recipe(row.product_id):
+            # placed with a recipe changed since
+            batch.add_version(row.recipe_version_id, row.quantity)
+        else:
+            batch.add(row.product_id, row.quantity)
+    result = {}
+    day = start
+    while day <= end:
+        result[day] = plans.get(day)
+        if result[day] is not None:
+            result[day].delivery.delivery_dates = delivery_dates
+            result[day].delivery.products = products
+            result[day].finalize(engine)
+        day += timedelta(days=1)
+    return result
+
+
+def build_actions(target_date, engine=None, materialized=True, kinds=None):
+    """Actions of target_date, computed from the plan rows only.
+
+    The recipes are expanded once per product (not per order line) and the whole
+    plan takes a constant number of queries, whatever the number of orders.
+    """
+    return build_range_actions(target_date, target_date, engine, materialized, kinds)[target_date]
+
+
+def _get_plans_cache_keys(start, end, kinds):
+    return {day: f"actions:{day.isoformat()}:{'-'.join(kinds or ['all'])}:{version}" for day, version in get_plan_versions(start, end).items()}
+
+
+def _build_missing_plans(keys, cached, kinds):
+    "Build the days of keys not found in cached in a single range pass, store them in both"
+    missing = [day for day, key in keys.items() if key not in cached]
+    if missing:
+        # stored for every process: not from recipes older than the versions of keys
+        sync_catalogue()
+        plans = build_range_actions(min(missing), max(missing), kinds=kinds)
+        built = {keys[day]: plans[day] for day in missing}
+        caches["plans"].set_many(built)
+        cached.update(built)
+
+
+def get_cached_range_actions(start, end, kinds=None):
+    """build_range_actions through the "plans" cache.
+
+    Each day is stored under its data version, so a change to the orders of a
+    day makes its plan (and only its plan) be rebuilt.
+    """
+    keys = _get_plans_cache_keys(start, end, kinds)
+    cached = caches["plans"].get_many(keys.values())
+    _build_missing_plans(keys, cached, kinds)
+    return {day: cached[key] for day, key in keys.items()}
+
+
+def get_cached_actions(target_date, kinds=None):
+    """build_actions through the "plans" cache. When target_date is not there,
+    the missing days around it (NAV_DAYS each side) are built in the same pass,
+    so that moving to a neighbour day is a cache hit."""
+    keys = _get_plans_cache_keys(target_date - timedelta(days=NAV_DAYS), target_date + timedelta(days=NAV_DAYS), kinds)
+    cached = caches["plans"].get_many(keys.values())
+    if keys[target_date] in cached:
+        return cached[keys[target_date]]
+
+    def build():
+        _build_missing_plans(keys, cached, kinds)
+        return cached[keys[target_date]]
+
+    # the tablets all ask for the same day at the same time
+    return single_flight("actions", keys[target_date], build)
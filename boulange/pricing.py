@@ -0,0 +1,59 @@
+"""What-if ingredient prices.
+
+The cost prices of the whole catalogue for hypothetical ingredient prices, from
+the recipe matrix of the numpy engine: its raw per-unit quantities (product x
+ingredient) times a price matrix holding the current prices and the simulated
+ones side by side, in one product. Nothing is saved. The weekly impact weighs
+the cost change of each product with its average quantity ordered over the
+last weeks.
+"""
+
+from collections import defaultdict
+from datetime import date, timedelta
+
+import numpy as np
+
+from .planning import get_order_totals
+from .recipe_matrix import get_recipe_matrix
+from .units import MICROCENTS, get_unit_price
+
+# weeks of validated orders averaged for the weekly impact
+VOLUME_WEEKS = 4
+
+
+def get_weekly_volumes(today, weeks=VOLUME_WEEKS):
+    "{product id: average quantity delivered per week} over the weeks before today"
+    volumes = defaultdict(int)
+    for total in get_order_totals(today - timedelta(weeks=weeks), today - timedelta(days=1)):
+        volumes[total["product"]] += total["quantity"]
+    return {product_id: quantity / weeks for product_id, quantity in volumes.items()}
+
+
+def simulate_prices(prices, today=None, weeks=VOLUME_WEEKS):
+    """Cost prices and margins, current and with prices ({ingredient id:
+    per_unit_price, per kg, liter or unit as on Ingredient}), of every product.
+    Ingredients no recipe uses have no effect."""
+    matrix = get_recipe_matrix()
+    simulated = matrix.unit_price.copy()
+    for ingredient_id, price in prices.items():
+        j = matrix.ingredient_index.get(ingredient_id)
+        if j is not None:
+            simulated[j] = get_unit_price(matrix.ingredients[j].unit, price) / MICROCENTS
+    costs = matrix.lines @ np.column_stack([matrix.unit_price, simulated])
+    margins = matrix.price[:, None] - costs
+    volumes = get_weekly_volumes(today or date.today(), weeks)
+    weekly_quantities = np.array([volumes.get(product_id, 0) for product_id in matrix.product_index])
+    impacts = (costs[:, 1] - costs[:, 0]) * weekly_quantities
+    products = [
+        {
+            "product": product_id,
+            "cost_price": costs[i, 0],
+            "new_cost_price": costs[i, 1],
+            "margin": margins[i, 0],
+            "new_margin": margins[i, 1],
+            "weekly_quantity": weekly_quantities[i],
+            "weekly_cost_impact": impacts[i],
+        }
+        for product_id, i in matrix.product_index.items()
+    ]
+    return {"products": products, "weekly_cost_impact": impacts.sum()}
@@ -0,0 +1,177 @@
+"""NumPy planning engine.
+
+The compiled recipes are laid out once as product x ingredient matrices (direct,
+base product and preparations, per unit). A batch then turns its product
+quantities into a vector and gets every ingredient total from a couple of matrix
+products instead of walking the recipes order line by order line.
+
+Selected with settings.BOULANGE_PLANNING_ENGINE = "numpy"; the output has the
+exact same structure as the python engine (see compare_actions and the
+compare_planning_engines command).
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+from .models import (
+    BakeryRecipe,
+    Soaking,
+    SubBatch,
+    get_compiled_recipe,
+    get_compiled_recipes,
+)
+from .units import MICROCENTS
+
+
+class RecipeMatrix:
+    def __init__(self, recipes):
+        self.recipes = recipes
+        self.product_index = {product_id: i for i, product_id in enumerate(recipes)}
+        ingredients = {}
+        for recipe in recipes.values():
+            for values in recipe.ingredients.values():
+                for ingredient in values:
+                    ingredients.setdefault(ingredient.pk, ingredient)
+        self.ingredients = list(ingredients.values())
+        self.ingredient_index = {ingredient_id: j for j, ingredient_id in enumerate(ingredients)}
+
+        shape = (len(recipes), len(self.ingredients))
+        self.direct = np.zeros(shape)
+        self.base_product = np.zeros(shape)
+        self.preparations = np.zeros(shape)
+        # raw recipe quantities, the ones priced (see boulange.pricing)
+        self.lines = np.zeros(shape)
+        for i, recipe in enumerate(recipes.values()):
+            for ingref, matrix in (("direct", self.direct), ("base_product", self.base_product), ("preparations", self.preparations)):
+                for ingredient, qty in recipe.ingredients[ingref].items():
+                    matrix[i, self.ingredient_index[ingredient.pk]] = qty
+            for ingredient, qty in recipe.line_quantities.items():
+                self.lines[i, self.ingredient_index[ingredient.pk]] = qty
+        products = [recipe.product for recipe in recipes.values()]
+        self.has_orig_product = np.array([recipe.base_product_id is not None for recipe in recipes.values()], dtype=bool)
+        # products made from an orig_product are baked with the dough at the root of its chain
+        self.bakery = np.where(self.has_orig_product[:, None], self.base_product, self.direct)
+        self.nb_units = np.array([product.nb_units for product in products], dtype=np.int64)
+        self.baked_by_batch = np.array([product.baked_by_batch for product in products], dtype=bool)
+        self.is_bread = np.array([product.is_bread for product in products], dtype=bool)
+        self.batch_weight = np.array([recipe.batch_weight for recipe in recipes.values()])
+        self.unit_weight = np.array([ingredient.unit_weight or 1 for ingredient in self.ingredients])
+        self.soaking_coef = np.array([ingredient.soaking_coef for ingredient in self.ingredients])
+        self.price = np.array([float(product.price) for product in products])
+        # € per g, liter or piece
+        self.unit_price = np.array([ingredient.unit_price for ingredient in self.ingredients]) / MICROCENTS
+
+    def vectorize(self, temp_products):
+        "Index and quantity vectors for a {product id: quantity} mapping, batch-baking rounding applied"
+        idx = np.array([self.product_index[product_id] for product_id in temp_products], dtype=np.int64)
+        quantities = np.array(list(temp_products.values()), dtype=np.int64)
+        nb_units = self.nb_units[idx]
+        remainder = quantities % nb_units
+        quantities = np.where(self.baked_by_batch[idx] & (remainder != 0), quantities + nb_units - remainder, quantities)
+        return idx, quantities
+
+    def column(self, ingredient):
+        return self.ingredient_index[ingredient.pk]
+
+
+# rebuilt from the compiled recipes, emptied by boulange.signals along with them
+_recipe_matrix = None
+
+
+def get_recipe_matrix(product_ids=()):
+    global _recipe_matrix
+    for product_id in product_ids:
+        # recompiles the catalogue when one of them is missing from it
+        get_compiled_recipe(product_id)
+    recipes = get_compiled_recipes()
+    if _recipe_matrix is None or _recipe_matrix.product_index.keys() != recipes.keys():
+        _recipe_matrix = RecipeMatrix(recipes)
+    return _recipe_matrix
+
+
+def clear_recipe_matrix():
+    global _recipe_matrix
+    _recipe_matrix = None
+
+
+def expand_bakery_batch(batch):
+    "Fill a BakeryBatch from its temp_products, weights included"
+    if not batch.temp_products:
+        return
+    product_ids = list(batch.temp_products)
+    matrix = get_recipe_matrix(product_ids)
+    idx, quantities = matrix.vectorize(batch.temp_products)
+    batch.nb_breads += int(quantities[matrix.is_bread[idx]].sum())
+
+    recipes = [matrix.recipes[product_id] for product_id in product_ids]
+    products = [recipe.product for recipe in recipes]
+    base_ids = np.array([recipe.base_product_id or recipe.product.pk for recipe in recipes])
+    base_product_ids = list(dict.fromkeys(base_ids.tolist()))
+    groups = (base_ids[None, :] == np.array(base_product_ids)[:, None]) * quantities
+    totals = groups @ matrix.bakery[idx]
+    weights = totals @ matrix.unit_weight
+
+    for b, base_product_id in enumerate(base_product_ids):
+        members = [i for i in range(len(products)) if base_ids[i] == base_product_id]
+        recipe = BakeryRecipe()
+        for i in members:
+            for ingredient in recipes[i].ingredients["base_product" if recipes[i].base_product_id else "direct"]:
+                recipe.ingredients.setdefault(ingredient.pk, float(totals[b, matrix.column(ingredient)]))
+        recipe.division = {product_ids[i]: int(quantities[i]) for i in members}
+        recipe.weight = float(weights[b])
+        batch.recipes[base_product_id] = recipe
+
+    for i, product in enumerate(products):
+        direct = recipes[i].ingredients["direct"]
+        if direct and recipes[i].base_product_id:
+            row = matrix.direct[idx[i]] * matrix.nb_units[idx[i]]
+            ingredients = {ingredient.pk: float(row[matrix.column(ingredient)]) for ingredient in direct}
+            batch.sub_batches_by_id.setdefault(recipes[i].base_product_id, {})[product.pk] = SubBatch(ingredients, float(matrix.batch_weight[idx[i]] * quantities[i]))
+
+
+def expand_preparation_batch(batch):
+    "Fill a PreparationBatch (levain and trempage) from its temp_products"
+    if not batch.temp_products:
+        return
+    matrix = get_recipe_matrix(batch.temp_products)
+    idx, quantities = matrix.vectorize(batch.temp_products)
+    totals = quantities @ matrix.preparations[idx]
+    soaking_totals = totals * matrix.soaking_coef
+    for product_id in batch.temp_products:
+        for ingredient in matrix.recipes[product_id].ingredients["preparations"]:
+            j = matrix.column(ingredient)
+            if ingredient.name.startswith("Levain"):
+                batch.levain.setdefault(ingredient.pk, float(totals[j]))
+            elif ingredient.soaking_ingredient and ingredient.pk not in batch.trempage:
+                soaking = batch.trempage[ingredient.pk] = Soaking(ingredient.soaking_ingredient.pk)
+                soaking.dry = float(totals[j])
+                soaking.soaking_qty = float(soaking_totals[j])
+                if ingredient.name == "Flocons de riz":
+                    soaking.warning = "⚠ prévoir 10% de marge"
+
+
+def compare_actions(expected, actual, tolerance=1e-6, path="actions"):
+    "List the differences between two Actions structures, floats compared with a relative tolerance"
+    if isinstance(expected, Mapping) and isinstance(actual, Mapping):
+        differences = []
+        if list(expected) != list(actual):
+            differences.append(f"{path}: keys {list(expected)} != {list(actual)}")
+        for key in expected:
+            if key in actual:
+                differences += compare_actions(expected[key], actual[key], tolerance, f"{path}[{key}]")
+        for attr in ("nb_breads", "sub_batches", "oven_runs", "levain_builds"):
+            if hasattr(expected, attr):
+                differences += compare_actions(getattr(expected, attr), getattr(actual, attr), tolerance, f"{path}.{attr}")
+        return differences
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [f"{path}: {len(expected)} items != {len(actual)}"]
+        return [difference for i, (e, a) in enumerate(zip(expected, actual)) for difference in compare_actions(e, a, tolerance, f"{path}[{i}]")]
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        if abs(expected - actual) > tolerance * max(1, abs(expected)):
+            return [f"{path}: {expected} != {actual}"]
+        return []
+    if expected != actual:
+        return [f"{path}: {expected!r} != {actual!r}"]
+    return []
@@ -10,6 +10,7 @@ from .models import (
     ProductLine,
     WeeklyDelivery,
 )
+from .pricing import VOLUME_WEEKS
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -28,6 +29,19 @@ class ProductLineSerializer(serializers.ModelSerializer):
 
 class ProductSerializer(serializers.ModelSerializer):
     raw_ingredients = ProductLineSerializer(many=True, read_only=True)
+    cost_price = serializers.SerializerMethodField()
+    weight = serializers.SerializerMethodField()
+    margin = serializers.SerializerMethodField()
+
+    # annotated by Product.objects.with_costs(), compiled recipe otherwise (created / updated product)
+    def get_cost_price(self, product):
+        return product.cost_per_unit if hasattr(product, "cost_per_unit") else product.cost_price
+
+    def get_weight(self, product):
+        return product.weight_per_unit if hasattr(product, "weight_per_unit") else product.weight
+
+    def get_margin(self, product):
+        return product.margin if hasattr(product, "margin") else product.price - product.cost_price
 
     class Meta:
         model = Product
@@ -39,6 +53,7 @@ class ProductSerializer(serializers.ModelSerializer):
             "raw_ingredients",
             "cost_price",
             "weight",
+            "margin",
             "active",
             "orig_product",
             "coef",
@@ -106,3 +121,110 @@ class OrderSerializer(serializers.ModelSerializer):
         for line in self.lines_data:
             OrderLine.objects.create(order=order, **line)
         return order
+
+
+class PriceSimulationSerializer(serializers.Serializer):
+    "Input of the price simulation: {ingredient id: per_unit_price} and the weeks of orders to average"
+
+    prices = serializers.DictField(child=serializers.DecimalField(max_digits=5, decimal_places=3, min_value=0))
+    weeks = serializers.IntegerField(min_value=1, max_value=52, default=VOLUME_WEEKS)
+
+    def validate_prices(self, prices):
+        try:
+            prices = {int(ingredient_id): price for ingredient_id, price in prices.items()}
+        except ValueError:
+            raise serializers.ValidationError("Les clés sont des ids d'ingrédients")
+        unknown = prices.keys() - set(Ingredient.objects.filter(pk__in=prices).values_list("pk", flat=True))
+        if unknown:
+            raise serializers.ValidationError(f"Ingrédients inconnus : {sorted(unknown)}")
+        return prices
+
+
+class ActionsSerializer(serializers.BaseSerializer):
+    """Read-only representation of a day's Actions.
+
+    Built from the ids the plan holds, in the plan order: no model instance is
+    looked up apart from the delivery dates (for the customer name). A "kinds"
+    context entry restricts the output to these batches.
+    """
+
+    @staticmethod
+    def _quantities(values, key):
+        return [{key: pk, "quantity": quantity} for pk, quantity in values.items()]
+
+    def _delivery(self, delivery):
+        return [
+            {
+                "delivery_date": delivery_date_id,
+                "customer": str(delivery.delivery_dates[delivery_date_id].weekly_delivery.customer),
+                "products": self._quantities(lines, "product"),
+            }
+            for delivery_date_id, lines in delivery.lines.items()
+        ]
+
+    def _bakery(self, bakery):
+        return {
+            "nb_breads": bakery.nb_breads,
+            "recipes": [
+                {
+                    "product": product_id,
+                    "ingredients": self._quantities(recipe.ingredients, "ingredient"),
+                    "division": self._quantities(recipe.division, "product"),
+                    "weight": recipe.weight,
+                    "sub_batches": [
+                        {
+                            "product": sub_product_id,
+                            "ingredients": self._quantities(sub_batch.ingredients, "ingredient"),
+                            "dough_weight": sub_batch.dough_weight,
+                        }
+                        for sub_product_id, sub_batch in bakery.sub_batches_by_id.get(product_id, {}).items()
+                    ],
+                }
+                for product_id, recipe in bakery.recipes.items()
+            ],
+            "oven_runs": [{"minutes": run.minutes, "load": run.load, "products": self._quantities(run.products, "product")} for run in bakery.oven_runs],
+        }
+
+    @staticmethod
+    def _trempage(trempage):
+        return [
+            {
+                "ingredient": ingredient_id,
+                "dry": soaking.dry,
+                "soaking_ingredient": soaking.soaking_ingredient_id,
+                "soaking_qty": soaking.soaking_qty,
+                "warning": soaking.warning,
+            }
+            for ingredient_id, soaking in trempage.items()
+        ]
+
+    def _preparation(self, preparation):
+        return {
+            "levain": self._quantities(preparation.levain, "ingredient"),
+            "trempage": self._trempage(preparation.trempage),
+            "levain_builds": [
+                {
+                    "ingredient": ingredient_id,
+                    "steps": [{"time": step.time.isoformat("minutes"), "seed": step.seed, "flour": step.flour, "water": step.water} for step in steps],
+                }
+                for ingredient_id, steps in preparation.levain_builds.items()
+            ],
+        }
+
+    def to_representation(self, actions):
+        if actions is None:
+            return None
+        kinds = self.context.get("kinds") or actions.KEYS
+        return {kind: getattr(self, f"_{kind}")(actions[kind]) for kind in actions.KEYS if kind in kinds}
+
+
+class IngredientForecastSerializer(ActionsSerializer):
+    "Read-only representation of an IngredientForecast, ids only as for the Actions"
+
+    def to_representation(self, forecast):
+        return {
+            "products": self._quantities(forecast.products, "product"),
+            "ingredients": self._quantities(forecast.ingredients, "ingredient"),
+            "levain": self._quantities(forecast.preparation.levain, "ingredient"),
+            "trempage": self._trempage(forecast.preparation.trempage),
+        }
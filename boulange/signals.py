@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import (
+    DeliveryDate,
+    Ingredient,
+    Order,
+    OrderLine,
+    Product,
+    ProductLine,
+    Settings,
+    WeeklyDelivery,
+    catalogue_cleared,
+    clear_catalogue,
+    sync_catalogue,
+)
+from .planning import (
+    clear_planning_window_days,
+    get_planning_window_days,
+    mark_production_plan_stale,
+    record_plan_changes,
+)
+from .recipe_matrix import clear_recipe_matrix
+
+
+@receiver(request_started)
+def request_starting(sender, environ=None, **kwargs):
+    # another gunicorn worker may have changed the catalogue; static files aside
+    path = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "") if environ else ""
+    if not path.startswith(settings.STATIC_URL):
+        sync_catalogue()
+
+
+@receiver(catalogue_cleared)
+def catalogue_clearing(sender, **kwargs):
+    clear_recipe_matrix()
+    clear_planning_window_days()
+
+
+@receiver(pre_save, sender=ProductLine)
+@receiver(pre_save, sender=Ingredient)
+def recipe_normalizing(sender, instance, **kwargs):
+    # raw saves included: fixtures do not hold the normalized fields
+    instance.normalize()
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductLine)
+@receiver([post_save, post_delete], sender=Ingredient)
+def recipe_changed(sender, **kwargs):
+    # the production plan stores product quantities and recipe versions only:
+    # the recipes are expanded when it is read, so there is nothing to refresh
+    # there, but every plan of today onwards read from now on differs
+    clear_catalogue()
+    record_plan_changes(catalogue=True)
+
+
+@receiver([post_save, post_delete], sender=Settings)
+def settings_changed(sender, **kwargs):
+    # the levain schedules of every plan read from now on may differ
+    clear_catalogue()
+    record_plan_changes()
+
+
+@receiver(pre_save, sender=Order)
+def order_moving(sender, instance, raw=False, **kwargs):
+    # the plan of the previous delivery date must be refreshed too
+    instance._previous_delivery_date_id = None
+    if instance.pk is not None and not raw:
+        instance._previous_delivery_date_id = Order.objects.filter(pk=instance.pk).values_list("delivery_date", flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Order)
+def order_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        mark_production_plan_stale([instance.delivery_date_id, getattr(instance, "_previous_delivery_date_id", None)])
+
+
+@receiver([post_save, post_delete], sender=OrderLine)
+def order_line_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if OrderLine.order.is_cached(instance):
+        delivery_date_id = instance.order.delivery_date_id
+    else:
+        delivery_date_id = Order.objects.filter(pk=instance.order_id).values_list("delivery_date", flat=True).first()
+    mark_production_plan_stale([delivery_date_id])
+
+
+@receiver(pre_save, sender=DeliveryDate)
+def delivery_date_moving(sender, instance, raw=False, **kwargs):
+    # the plans of the day it leaves change too
+    instance._previous_date = None
+    if instance.pk is not None and not raw:
+        instance._previous_date = DeliveryDate.objects.filter(pk=instance.pk).values_list("date", flat=True).first()
+
+
+@receiver(post_save, sender=DeliveryDate)
+def delivery_date_changed(sender, instance, created=False, raw=False, **kwargs):
+    if not raw and not created:
+        mark_production_plan_stale([instance.pk])
+        previous = getattr(instance, "_previous_date", None)
+        if previous is not None and previous != instance.date:
+            record_plan_changes(days=[previous])
+
+
+@receiver(post_save, sender=WeeklyDelivery)
+def weekly_delivery_changed(sender, instance, created=False, raw=False, **kwargs):
+    # the lead days move the bakery and preparation days of every planned date
+    if raw:
+        return
+    window_days = get_planning_window_days()
+    clear_planning_window_days()
+    if not created:
+        mark_production_plan_stale(DeliveryDate.objects.filter(weekly_delivery=instance, productionplan__isnull=False).values_list("pk", flat=True).distinct())
+    # and when the planning window moves, the one of every process
+    if get_planning_window_days() != window_days:
+        record_plan_changes()
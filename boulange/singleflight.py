@@ -0,0 +1,86 @@
+"""Single-flight: concurrent identical computations run only once.
+
+The first caller for a key takes a lock in the "plans" cache, computes and
+stores the result. The callers arriving meanwhile wait for that result instead
+of computing it again. The lock is a cache.add(), which is atomic in the
+database cache, so this holds across every gunicorn worker.
+
+Keys must include the data version of what is computed (see
+planning.get_plan_versions): results are only kept for RESULT_TIMEOUT seconds,
+to be shared by concurrent requests, not as a cache.
+"""
+
+import logging
+import time
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# how long a computation may hold the lock before waiting callers give up on it
+LOCK_TIMEOUT = 60
+RESULT_TIMEOUT = 30
+POLL_INTERVAL = 0.05
+# "computed": ran compute(), "coalesced": got the result of a concurrent call,
+# "timeouts": waited LOCK_TIMEOUT for nothing and computed anyway
+EVENTS = ("computed", "coalesced", "timeouts")
+# set of the names events were counted for
+NAMES_KEY = "singleflight:names"
+
+_missing = object()
+
+
+def _count(name, event):
+    cache = caches["plans"]
+    names = cache.get(NAMES_KEY, set())
+    if name not in names:
+        # lost to a concurrent update at worst, added again on the next count
+        cache.set(NAMES_KEY, names | {name}, timeout=None)
+    key = f"singleflight:stats:{name}:{event}"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # culled between add and incr
+        cache.set(key, 1, timeout=None)
+
+
+def get_names():
+    "names given to single_flight, by every process, that counted events"
+    return sorted(caches["plans"].get(NAMES_KEY, set()))
+
+
+def get_stats(name):
+    cache = caches["plans"]
+    return {event: cache.get(f"singleflight:stats:{name}:{event}", 0) for event in EVENTS}
+
+
+def single_flight(name, key, compute, lock_timeout=LOCK_TIMEOUT):
+    "compute(), unless a call with the same name and key is already running: then its result"
+    cache = caches["plans"]
+    result_key = f"singleflight:{name}:{key}"
+    lock_key = f"{result_key}:lock"
+    deadline = time.monotonic() + lock_timeout
+    while True:
+        if cache.add(lock_key, True, timeout=lock_timeout):
+            try:
+                # the previous holder may have just finished
+                result = cache.get(result_key, _missing)
+                if result is _missing:
+                    result = compute()
+                    cache.set(result_key, result, timeout=RESULT_TIMEOUT)
+                    _count(name, "computed")
+                else:
+                    _count(name, "coalesced")
+            finally:
+                cache.delete(lock_key)
+            return result
+        time.sleep(POLL_INTERVAL)
+        result = cache.get(result_key, _missing)
+        if result is not _missing:
+            _count(name, "coalesced")
+            return result
+        if time.monotonic() > deadline:
+            logger.warning("single flight %s %s: lock held for more than %ss, computing anyway", name, key, lock_timeout)
+            _count(name, "timeouts")
+            return compute()
@@ -0,0 +1,122 @@
+"""Snapshots of the printed sections of the actions page.
+
+A printed section is stored as its quantities flattened to {line: quantity},
+from the same id-only representation as the actions API, along with the digest
+of these lines. Comparing the lines of the last print with the current plan
+gives what changed since, without rendering the plan again.
+"""
+
+import hashlib
+import json
+
+from .models import (
+    DeliveryDate,
+    PrintedPlan,
+    get_compiled_ingredient,
+    get_compiled_product,
+)
+from .planning import SECTIONS, get_cached_actions
+from .serializers import ActionsSerializer
+
+# list items are keyed by the first of these they hold, by their position otherwise
+IDENTITY_KEYS = ("delivery_date", "product", "ingredient", "time")
+# ids that are not quantities
+SKIPPED_KEYS = ("soaking_ingredient",)
+# the oven runs are part of the bakery batch but have their own printed section
+OVEN_RUNS = "oven_runs/"
+# line segment -> words of its description, nothing for the structure ones
+LABELS = {
+    "recipes": "",
+    "ingredients": "",
+    "products": "",
+    "quantity": "",
+    "steps": "",
+    "levain": "",
+    "nb_breads": "Nb de pains cuits",
+    "division": "division",
+    "weight": "poids total",
+    "sub_batches": "dont",
+    "dough_weight": "pâton",
+    "oven_runs": "fournée",
+    "minutes": "durée",
+    "load": "remplissage",
+    "trempage": "trempage",
+    "dry": "sec",
+    "soaking_qty": "eau",
+    "levain_builds": "rafraîchi",
+    "seed": "chef",
+    "flour": "farine",
+    "water": "eau",
+}
+
+
+def _flatten(data, path, lines):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key not in IDENTITY_KEYS and key not in SKIPPED_KEYS:
+                _flatten(value, f"{path}{key}/", lines)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            identity = next((f"{key}:{item[key]}" for key in IDENTITY_KEYS if key in item), str(i + 1)) if isinstance(item, dict) else str(i + 1)
+            _flatten(item, f"{path}{identity}/", lines)
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        lines[path.rstrip("/")] = round(data, 1)
+
+
+def get_plan_lines(actions, section):
+    "{line: quantity} of a section of actions (None for a day with nothing to do)"
+    if actions is None:
+        return {}
+    kind = SECTIONS[section]
+    lines = {}
+    _flatten(ActionsSerializer(actions, context={"kinds": [kind]}).data[kind], "", lines)
+    if section == "four":
+        return {line: qty for line, qty in lines.items() if line.startswith(OVEN_RUNS)}
+    if kind == "bakery":
+        return {line: qty for line, qty in lines.items() if not line.startswith(OVEN_RUNS)}
+    return lines
+
+
+def get_digest(lines):
+    return hashlib.sha256(json.dumps(lines, sort_keys=True).encode()).hexdigest()
+
+
+def save_printed_plan(day, section, actions):
+    "Snapshot the section of actions being printed, unless it is the same as the last print"
+    lines = get_plan_lines(actions, section)
+    digest = get_digest(lines)
+    if PrintedPlan.objects.filter(day=day, section=section).order_by("-pk").values_list("digest", flat=True).first() != digest:
+        PrintedPlan.objects.create(day=day, section=section, digest=digest, lines=lines)
+
+
+def _describe(line, delivery_dates):
+    words = []
+    for segment in line.split("/"):
+        key, _, value = segment.partition(":")
+        if key == "product":
+            words.append(str(get_compiled_product(int(value))))
+        elif key == "ingredient":
+            words.append(str(get_compiled_ingredient(int(value))))
+        elif key == "delivery_date":
+            words.append(str(delivery_dates[int(value)].weekly_delivery.customer))
+        elif key == "time":
+            words.append(value)
+        elif LABELS.get(segment, segment):
+            words.append(LABELS.get(segment, segment))
+    return " / ".join(words)
+
+
+def get_plan_changes(day, section):
+    """(last PrintedPlan of the section, [(line description, printed quantity,
+    current quantity)] of the lines that differ), (None, []) if never printed.
+    A missing line has a None quantity."""
+    printed = PrintedPlan.objects.filter(day=day, section=section).order_by("-pk").first()
+    if printed is None:
+        return None, []
+    lines = get_plan_lines(get_cached_actions(day, kinds=[SECTIONS[section]]), section)
+    if get_digest(lines) == printed.digest:
+        return printed, []
+    changed = [line for line in {**lines, **printed.lines} if lines.get(line) != printed.lines.get(line)]
+    delivery_date_ids = {int(segment.partition(":")[2]) for line in changed for segment in line.split("/") if segment.startswith("delivery_date:")}
+    delivery_dates = DeliveryDate.objects.select_related("weekly_delivery__customer").in_bulk(delivery_date_ids)
+    return printed, [(_describe(line, delivery_dates), printed.lines.get(line), lines.get(line)) for line in changed]
@@ -0,0 +1,206 @@
+// Bakehouse screen: the actions of a day rendered from the JSON API, through the
+// service worker cache (see the boulange/sw.js template). Moving between days
+// needs no page load and works offline for the days already fetched; the plans
+// of the coming days are fetched in the background.
+(() => {
+  const root = document.getElementById("actions-screen");
+  const api = root.dataset.api;
+  const navDays = Number(root.dataset.navDays);
+  const refreshSeconds = Number(root.dataset.refreshSeconds);
+  const specialUnits = root.dataset.specialUnits.split(" ");
+  const status = document.getElementById("actions-screen-status");
+  let catalogue = null;
+  let current = null;
+
+  function localToday() {
+    const now = new Date();
+    return new Date(Date.UTC(now.getFullYear(), now.getMonth(), now.getDate())).toISOString().slice(0, 10);
+  }
+
+  function addDays(day, days) {
+    const date = new Date(`${day}T00:00:00Z`);
+    date.setUTCDate(date.getUTCDate() + days);
+    return date.toISOString().slice(0, 10);
+  }
+
+  function dayLabel(day) {
+    return new Date(`${day}T00:00:00Z`).toLocaleDateString("fr-FR", { weekday: "short", day: "2-digit", month: "2-digit", timeZone: "UTC" });
+  }
+
+  function actionsUrl(day) {
+    return `${api}actions/${day}/`;
+  }
+
+  async function getJSON(url) {
+    const response = await fetch(url, { credentials: "same-origin" });
+    if (!response.ok) {
+      throw new Error(`${url}: ${response.status}`);
+    }
+    return response.json();
+  }
+
+  async function loadCatalogue() {
+    const [products, ingredients] = await Promise.all([getJSON(`${api}products/`), getJSON(`${api}ingredients/`)]);
+    catalogue = {
+      products: new Map(products.map((product) => [product.id, product])),
+      ingredients: new Map(ingredients.map((ingredient) => [ingredient.id, ingredient])),
+    };
+  }
+
+  function el(tag, text, children = []) {
+    const node = document.createElement(tag);
+    if (text !== undefined && text !== null) {
+      node.textContent = text;
+    }
+    children.forEach((child) => node.appendChild(child));
+    return node;
+  }
+
+  function productName(id) {
+    const product = catalogue.products.get(id);
+    return product ? `${product.name}/${product.ref}` : `#${id}`;
+  }
+
+  // same rounding as the bround template filter
+  function ingredientLine(id, quantity) {
+    const ingredient = catalogue.ingredients.get(id);
+    if (!ingredient) {
+      return `#${id} : ${quantity}`;
+    }
+    let rounded = Math.round(quantity / 10) * 10;
+    if (!ingredient.decimal_round) {
+      rounded = Math.round(quantity);
+    } else if (specialUnits.includes(ingredient.name)) {
+      rounded = quantity;
+    }
+    return `${ingredient.name} : ${rounded} ${ingredient.unit}`;
+  }
+
+  function card(title, lines) {
+    const node = el("article", null, [el("header", null, [el("h3", title)]), el("ul", null, lines.map((line) => el("li", line)))]);
+    node.className = "card";
+    return node;
+  }
+
+  function section(title, cards, intro) {
+    const grid = el("div", null, cards);
+    grid.className = "flex three";
+    return el("section", null, [el("h2", title), ...(intro ? [el("p", intro)] : []), grid]);
+  }
+
+  function render(day, actions) {
+    const container = document.getElementById("actions-screen-day");
+    container.replaceChildren();
+    if (!actions) {
+      container.appendChild(el("p", "Rien de prévu"));
+      return;
+    }
+    const { bakery, delivery, preparation } = actions;
+    if (bakery.recipes.length) {
+      const recipes = bakery.recipes.map((recipe) =>
+        card(productName(recipe.product), [
+          ...recipe.ingredients.filter((line) => line.quantity).map((line) => ingredientLine(line.ingredient, line.quantity)),
+          `Poids total : ${Math.round(recipe.weight / 10) * 10} g`,
+          ...recipe.division.map((line) => `→ ${productName(line.product)} : ${line.quantity}`),
+        ]),
+      );
+      container.appendChild(section("Boulange", recipes, `Nb de pains cuits : ${bakery.nb_breads}`));
+    }
+    if (bakery.oven_runs.length) {
+      const runs = bakery.oven_runs.map((run, i) =>
+        card(
+          `Fournée ${i + 1} : ${run.minutes} min`,
+          run.products.map((line) => `${productName(line.product)} : ${line.quantity}`),
+        ),
+      );
+      container.appendChild(section("Four", runs));
+    }
+    if (delivery.length) {
+      const deliveries = delivery.map((dd) =>
+        card(
+          dd.customer,
+          dd.products.map((line) => `${productName(line.product)} : ${line.quantity}`),
+        ),
+      );
+      container.appendChild(section("Livraison", deliveries));
+    }
+    const preparations = [];
+    if (preparation.levain.length) {
+      preparations.push(card("Levains", preparation.levain.map((line) => ingredientLine(line.ingredient, line.quantity))));
+    }
+    if (preparation.trempage.length) {
+      preparations.push(
+        card(
+          "Trempage",
+          preparation.trempage.map((soaking) => `${ingredientLine(soaking.ingredient, soaking.dry)} + ${ingredientLine(soaking.soaking_ingredient, soaking.soaking_qty)} ${soaking.warning}`),
+        ),
+      );
+    }
+    if (preparations.length) {
+      container.appendChild(section("Préparations", preparations));
+    }
+  }
+
+  function renderNav() {
+    const nav = document.getElementById("actions-screen-nav");
+    nav.replaceChildren();
+    for (let i = -navDays; i <= navDays; i++) {
+      const day = addDays(current, i);
+      const button = el("button", dayLabel(day));
+      button.className = day === current ? "" : "pseudo";
+      button.addEventListener("click", () => show(day));
+      nav.appendChild(button);
+    }
+  }
+
+  async function show(day) {
+    current = day;
+    history.replaceState(null, "", `#${day}`);
+    renderNav();
+    try {
+      if (!catalogue) {
+        await loadCatalogue();
+      }
+      render(day, await getJSON(actionsUrl(day)));
+      status.textContent = navigator.onLine ? "" : "Hors ligne : dernières données reçues";
+    } catch (error) {
+      status.textContent = `Hors ligne : ${dayLabel(day)} n'a pas encore été chargé`;
+    }
+  }
+
+  // fills the service worker cache with the coming days
+  function prefetch() {
+    const today = localToday();
+    for (let i = 0; i <= navDays; i++) {
+      fetch(actionsUrl(addDays(today, i)), { credentials: "same-origin" }).catch(() => null);
+    }
+  }
+
+  if ("serviceWorker" in navigator) {
+    navigator.serviceWorker.register(root.dataset.serviceWorker);
+    navigator.serviceWorker.addEventListener("message", (event) => {
+      if (event.data.type !== "updated") {
+        return;
+      }
+      const path = new URL(event.data.url).pathname;
+      if (!path.startsWith(`${api}actions/`)) {
+        // products or ingredients: read again on the next display
+        catalogue = null;
+      } else if (path === actionsUrl(current)) {
+        show(current);
+      }
+    });
+  }
+  window.addEventListener("online", () => {
+    show(current);
+    prefetch();
+  });
+  setInterval(() => {
+    // asking again is enough: the service worker revalidates in the background
+    show(current);
+    prefetch();
+  }, refreshSeconds * 1000);
+
+  show(location.hash.slice(1) || localToday());
+  prefetch();
+})();
@@ -0,0 +1,144 @@
+"""Ingredient stock ledger.
+
+Deliveries and inventories are entered in the admin, the consumption of each
+day is posted from its plan once the day is over (post_stock_consumption
+command). Every movement holds the running balance of its ingredient, so the
+current stock is read from the last movement of each ingredient (one indexed
+query) instead of replaying the ledger.
+
+The ledger is not append-only: a movement entered for a past day rewrites the
+balances of the movements of the days after, and the difference of the next
+inventory of its ingredient (see _rebalance_later_movements). A row tells the
+stock of its day as known now, not as it was when it was written.
+"""
+
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Max, Min, OuterRef, Q, Subquery
+
+from .forecast import IngredientForecast
+from .models import Ingredient, StockMovement
+from .planning import MAX_RANGE_DAYS, build_range_actions, get_cached_range_actions
+
+# days ahead checked for stock-outs
+STOCK_HORIZON_DAYS = 14
+
+
+def get_stock_balances(ingredient_ids=None, day=None):
+    """{ingredient id: stock} of the ingredients found in the ledger, current or
+    at the end of day. The ledger is in (day, id) order: a movement entered for
+    a past day comes before those of the days after."""
+    movements = StockMovement.objects.filter(ingredient=OuterRef("pk"))
+    if day is not None:
+        movements = movements.filter(day__lte=day)
+    last = movements.order_by("-day", "-pk").values("balance")[:1]
+    ingredients = Ingredient.objects.all()
+    if ingredient_ids is not None:
+        ingredients = ingredients.filter(pk__in=ingredient_ids)
+    return dict(ingredients.annotate(stock=Subquery(last)).filter(stock__isnull=False).values_list("pk", "stock"))
+
+
+def record_stock_movements(day, kind, quantities):
+    """Append one movement per {ingredient id: quantity} on day, their balances
+    computed from the stock at the end of day in the same transaction. The
+    quantities of an inventory are the counted stock, stored as the difference
+    with the ledger. The movements of the days after are rebalanced."""
+    with transaction.atomic():
+        # serializes the writers on the ingredients involved
+        list(Ingredient.objects.select_for_update().filter(pk__in=quantities).values_list("pk"))
+        balances = get_stock_balances(quantities, day)
+        movements = []
+        for ingredient_id, quantity in quantities.items():
+            previous = balances.get(ingredient_id, 0)
+            if kind == "inventory":
+                quantity -= previous
+            movements.append(StockMovement(ingredient_id=ingredient_id, day=day, kind=kind, quantity=quantity, balance=previous + quantity))
+        movements = StockMovement.objects.bulk_create(movements)
+        _rebalance_later_movements(day, {movement.ingredient_id: movement.quantity for movement in movements})
+        return movements
+
+
+def _rebalance_later_movements(day, quantities):
+    """Carry {ingredient id: quantity} appended on day over the movements of the
+    days after: their balances move along up to the next inventory of the
+    ingredient, whose counted stock stays and whose difference absorbs it."""
+    changed = []
+    inventoried = set()
+    for movement in StockMovement.objects.filter(ingredient__in=quantities, day__gt=day).order_by("ingredient", "day", "pk"):
+        if movement.ingredient_id in inventoried:
+            continue
+        if movement.kind == "inventory":
+            movement.quantity -= quantities[movement.ingredient_id]
+            inventoried.add(movement.ingredient_id)
+        else:
+            movement.balance += quantities[movement.ingredient_id]
+        changed.append(movement)
+    StockMovement.objects.bulk_update(changed, ["quantity", "balance"])
+
+
+def get_consumption(actions):
+    """{ingredient id: quantity} used on the day of actions: the dough of its bakery
+    batch, the soaking being done the day of its preparation batch. Levains are
+    made here: their flour and water are counted, as IngredientForecast expands
+    them, with the dough they go in (a levain without them is counted as is)."""
+    baked = IngredientForecast()
+    for product_id, quantity in actions.bakery.temp_products.items():
+        baked.add(product_id, quantity)
+    # the past days bake the lines placed with an older recipe with it
+    for version_id, quantity in actions.bakery.temp_versions.items():
+        baked.add_version(version_id, quantity)
+    baked.finalize()
+    consumption = dict(baked.ingredients)
+    for trempage, sign in ((baked.preparation.trempage, -1), (actions.preparation.trempage, 1)):
+        for ingredient_id, soaking in trempage.items():
+            consumption[ingredient_id] = consumption.get(ingredient_id, 0) + sign * soaking.dry
+            consumption[soaking.soaking_ingredient_id] = consumption.get(soaking.soaking_ingredient_id, 0) + sign * soaking.soaking_qty
+    consumption = {ingredient_id: round(quantity, 3) for ingredient_id, quantity in consumption.items()}
+    return {ingredient_id: quantity for ingredient_id, quantity in consumption.items() if quantity}
+
+
+def post_stock_consumption(until):
+    """Post the consumption of the days after the last posted one, up to until.
+    The ledger starts with its first movement: nothing is posted before. Returns
+    the number of days posted.
+
+    The last posted day is read and the days after posted in one transaction,
+    the posters serialized on the ingredients; a day posted twice anyway fails
+    on the unique consumption constraint of StockMovement."""
+    with transaction.atomic():
+        list(Ingredient.objects.select_for_update().values_list("pk"))
+        days = StockMovement.objects.aggregate(first=Min("day"), posted=Max("day", filter=Q(kind="consumption")))
+        if days["first"] is None:
+            return 0
+        start = days["posted"] + timedelta(days=1) if days["posted"] else days["first"]
+        posted = 0
+        while start <= until:
+            end = min(until, start + timedelta(days=MAX_RANGE_DAYS - 1))
+            for day, actions in build_range_actions(start, end).items():
+                consumption = get_consumption(actions) if actions else {}
+                if consumption:
+                    record_stock_movements(day, "consumption", {ingredient_id: -quantity for ingredient_id, quantity in consumption.items()})
+                    posted += 1
+            start = end + timedelta(days=1)
+        return posted
+
+
+def get_posted_until():
+    "Last day whose consumption is posted, None before the first one"
+    return StockMovement.objects.filter(kind="consumption").aggregate(day=Max("day"))["day"]
+
+
+def get_stock_outs(balances, start=None, days=STOCK_HORIZON_DAYS):
+    """{ingredient id: day} of the ingredients of balances that run out within
+    days from start (today), from the plans of these days."""
+    start = start or date.today()
+    balances = dict(balances)
+    stock_outs = {}
+    for day, actions in get_cached_range_actions(start, start + timedelta(days=days - 1)).items():
+        for ingredient_id, quantity in (get_consumption(actions) if actions else {}).items():
+            if ingredient_id in balances:
+                balances[ingredient_id] -= quantity
+                if balances[ingredient_id] < 0:
+                    stock_outs.setdefault(ingredient_id, day)
+    return stock_outs
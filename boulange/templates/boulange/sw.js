@@ -0,0 +1,85 @@
+// Service worker of the bakehouse screen (boulange/actions_screen.html).
+//
+// Everything it handles is answered from its cache at once and revalidated in
+// the background: the JSON of the API with the ETag of the cached response, so
+// an unchanged plan costs a 304. The pages are told when a newer plan came in.
+// Only the endpoints the screen reads are cached, and the whole cache is
+// dropped as soon as the API refuses them (logged out): the logout response
+// clears it too (Clear-Site-Data).
+const CACHE = "boulange-screen-v2";
+const SHELL = [{% for url in shell %}"{{ url }}"{% if not forloop.last %}, {% endif %}{% endfor %}];
+const API = [{% for url in api %}"{{ url }}"{% if not forloop.last %}, {% endif %}{% endfor %}];
+const ACTIONS_API = "{{ actions_api }}";
+
+function isApi(path) {
+  return API.includes(path) || path.startsWith(ACTIONS_API);
+}
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches
+      .open(CACHE)
+      .then((cache) => cache.addAll(SHELL))
+      .then(() => self.skipWaiting()),
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches
+      .keys()
+      .then((keys) => Promise.all(keys.filter((key) => key !== CACHE).map((key) => caches.delete(key))))
+      .then(() => self.clients.claim()),
+  );
+});
+
+async function notify(url) {
+  for (const client of await self.clients.matchAll()) {
+    client.postMessage({ type: "updated", url });
+  }
+}
+
+async function revalidate(request, cached) {
+  const headers = new Headers(request.headers);
+  const etag = cached && cached.headers.get("ETag");
+  if (etag) {
+    headers.set("If-None-Match", etag);
+  }
+  const response = await fetch(request.url, { headers, credentials: "same-origin", cache: "no-store" });
+  if (response.status === 304) {
+    return cached;
+  }
+  if (response.status === 401 || response.status === 403) {
+    await caches.delete(CACHE);
+    return response;
+  }
+  if (response.ok) {
+    const cache = await caches.open(CACHE);
+    await cache.put(request, response.clone());
+    if (cached && isApi(new URL(request.url).pathname)) {
+      await notify(request.url);
+    }
+  }
+  return response;
+}
+
+async function respond(event) {
+  const cached = await caches.match(event.request);
+  const update = revalidate(event.request, cached);
+  if (cached) {
+    // offline, the cached copy is all there is
+    event.waitUntil(update.catch(() => null));
+    return cached;
+  }
+  return update;
+}
+
+self.addEventListener("fetch", (event) => {
+  const url = new URL(event.request.url);
+  if (event.request.method !== "GET" || url.origin !== self.location.origin) {
+    return;
+  }
+  if (isApi(url.pathname) || SHELL.includes(url.pathname)) {
+    event.respondWith(respond(event));
+  }
+});
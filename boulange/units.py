@@ -0,0 +1,54 @@
+"""Integer units of the cost and weight computations.
+
+Recipe quantities are normalized when written into base units, the thousandths
+of their unit (milligrams for g, millilitres for l, thousandths of a piece for
+eggs), ingredient prices into micro-cents per g, l or piece and the weight of a
+base unit into milligrams. Costing or weighing a recipe is then a sum of
+integer products, exact and the same for every unit; the only division is the
+final one, into euros or grams.
+"""
+
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+
+from boulange import SPECIAL_UNITS_WEIGHTS
+
+# base units in one g, l or piece
+BASE_UNITS = 1000
+# micro-cents in one euro
+MICROCENTS = 10**8
+MG_PER_G = 1000
+# Product.coef is applied as an integer number of thousandths
+COEF_SCALE = 1000
+
+
+def get_base_quantity(quantity):
+    "base units of a quantity given in its recipe unit"
+    return round(quantity * BASE_UNITS)
+
+
+def get_unit_price(unit, per_unit_price):
+    "micro-cents per g, l or piece of a price per kg, liter or piece"
+    price = Decimal(str(per_unit_price)) * MICROCENTS
+    if unit == "g":
+        price /= 1000
+    return int(price.to_integral_value())
+
+
+def get_unit_weight(unit):
+    "milligrams in one base unit, None when the unit has no known weight"
+    if unit == "g":
+        return 1
+    # grams per piece are milligrams per thousandth of a piece
+    return SPECIAL_UNITS_WEIGHTS.get(unit)
+
+
+def get_scaled_coef(coef):
+    return round(coef * COEF_SCALE)
+
+
+def validate_coef(coef):
+    "Product.coef validator: a coef finer than COEF_SCALE would be silently rounded"
+    if abs(coef * COEF_SCALE - get_scaled_coef(coef)) > 1e-6:
+        raise ValidationError("Coefficient au millième près au plus (%(coef)s)", params={"coef": coef})
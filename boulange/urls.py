@@ -35,7 +35,16 @@ urlpatterns = [
     path("products/", views.products, name="products"),
     path("actions/<int:year>/<int:month>/<int:day>/", views.actions, name="actions", kwargs={"to_print": False}),
     path("actions_print/<section>/<int:year>/<int:month>/<int:day>/", views.actions, name="actions_print", kwargs={"to_print": True}),
+    path("actions_changes/<section>/<int:year>/<int:month>/<int:day>/", views.actions_changes, name="actions_changes"),
+    path("actions_section/<section>/<int:year>/<int:month>/<int:day>/", views.actions_section, name="actions_section"),
+    path("actions_events/<int:year>/<int:month>/<int:day>/", views.actions_events, name="actions_events"),
     path("actions/", views.actions, name="actions"),
+    path("actions/ecran/", views.actions_screen, name="actions_screen"),
+    path("actions/sw.js", views.service_worker, name="service_worker"),
+    path("actions/<int:year>/<int:month>/<int:day>/to/<int:to_year>/<int:to_month>/<int:to_day>/", views.actions_range, name="actions_range"),
+    path("forecast/", views.forecast, name="forecast"),
+    path("forecast/<int:year>/<int:month>/<int:day>/to/<int:to_year>/<int:to_month>/<int:to_day>/", views.forecast, name="forecast"),
+    path("stock/", views.stock, name="stock"),
     path("check_delivery_dates_consistency/", views.check_delivery_dates_consistency, name="check_delivery_dates_consistency"),
     path(
         "delivery_receipt/<int:delivery_date_id>/",
@@ -49,10 +58,25 @@ urlpatterns = [
         views.generate_delivery_dates,
         name="generate_delivery_dates",
     ),
+    path(
+        "api/simulate_prices/",
+        views.simulate_ingredient_prices,
+        name="simulate_ingredient_prices",
+    ),
     path(
         "api/actions/<int:year>-<int:month>-<int:day>/",
         views.get_actions,
         name="get_actions",
     ),
+    path(
+        "api/actions/<int:year>-<int:month>-<int:day>..<int:to_year>-<int:to_month>-<int:to_day>/",
+        views.get_range_actions,
+        name="get_range_actions",
+    ),
+    path(
+        "api/forecast/<int:year>-<int:month>-<int:day>..<int:to_year>-<int:to_month>-<int:to_day>/",
+        views.get_ingredient_forecast,
+        name="get_ingredient_forecast",
+    ),
     path("api-auth/", include("rest_framework.urls", namespace="rest_framework")),
 ]
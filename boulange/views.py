@@ -3,22 +3,30 @@ from datetime import date, timedelta
 from functools import wraps
 
 import requests
+from django.conf import settings
+from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
 from django.db import transaction
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Prefetch, Q
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django_filters import rest_framework as filters
 from rest_framework import permissions, viewsets
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 
+from boulange import SPECIAL_UNITS_WEIGHTS
 from resto.settings import SUMUP_API_KEY, SUMUP_CHECKOUTS_URL, SUMUP_MERCHANT_CODE
 
+from .events import plan_events
+from .forecast import MAX_FORECAST_DAYS, get_cached_ingredient_forecast
 from .models import (
     ORDER_WINDOW_DAYS,
     Checkout,
@@ -28,20 +36,43 @@ from .models import (
     Order,
     OrderLine,
     Product,
+    ProductionPlan,
     ProductLine,
     ResetAccountToken,
     WeeklyDelivery,
+    get_catalogue_version,
 )
+from .planning import (
+    MAX_RANGE_DAYS,
+    NAV_DAYS,
+    SECTIONS,
+    build_range_actions,
+    get_cached_actions,
+    get_delivery_version,
+    get_plan_version,
+)
+from .pricing import simulate_prices
 from .serializers import (
+    ActionsSerializer,
     CustomerSerializer,
     DeliveryDateSerializer,
+    IngredientForecastSerializer,
     IngredientSerializer,
     OrderLineSerializer,
     OrderSerializer,
+    PriceSimulationSerializer,
     ProductLineSerializer,
     ProductSerializer,
     WeeklyDeliverySerializer,
 )
+from .singleflight import single_flight
+from .snapshots import get_plan_changes, save_printed_plan
+from .stock import (
+    STOCK_HORIZON_DAYS,
+    get_posted_until,
+    get_stock_balances,
+    get_stock_outs,
+)
 
 
 def staff_required(view_func):
@@ -66,10 +97,29 @@ class IngredientViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAdminUser]
 
 
+# ordering of the products page -> its label
+PRODUCT_ORDERINGS = [("", "affichage"), ("margin", "marge"), ("-margin", "marge décroissante"), ("cost_price", "prix de revient")]
+
+
+class ProductFilter(filters.FilterSet):
+    min_margin = filters.NumberFilter(field_name="margin", lookup_expr="gte")
+    max_margin = filters.NumberFilter(field_name="margin", lookup_expr="lte")
+    ordering = filters.OrderingFilter(fields=["id", "name", "ref", "price", ("cost_per_unit", "cost_price"), ("weight_per_unit", "weight"), "margin"])
+
+    class Meta:
+        model = Product
+        fields = ["active", "orig_product"]
+
+
 class ProductViewSet(viewsets.ModelViewSet):
+    # cost price, weight and margin from Product.objects.with_costs(), so they can be filtered and sorted on
     queryset = Product.objects.all().order_by("id")
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAdminUser]
+    filterset_class = ProductFilter
+
+    def get_queryset(self):
+        return Product.objects.with_costs().prefetch_related("raw_ingredients__ingredient").order_by("id")
 
 
 class ProductLineViewSet(viewsets.ModelViewSet):
@@ -106,7 +156,7 @@ class OrderFilter(filters.FilterSet):
 
 
 class OrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.all().order_by("id")
+    queryset = Order.objects.with_totals().prefetch_related("lines__product").order_by("id")
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAdminUser]
     filterset_class = OrderFilter
@@ -126,27 +176,85 @@ def generate_delivery_dates(request):
     return Response({"message": "Delivery dates generated!"})
 
 
-def _get_actions(target_date):
-    delivery_dates = (
-        DeliveryDate.objects.filter(date__gte=target_date)
-        .filter(active=True)
-        .filter(date__lte=target_date + timedelta(days=2))
-        .select_related("weekly_delivery")
-        .prefetch_related("order_set__lines__product__orig_product__raw_ingredients__ingredient")
-    )
-    actions = None
-    for delivery_date in delivery_dates:
-        for order in delivery_date.order_set.filter(validated=True):
-            actions = order.get_actions(target_date, actions)
-    if actions:
-        actions.finalize()
-    return actions
+@api_view(["POST"])
+@permission_classes([permissions.IsAdminUser])
+def simulate_ingredient_prices(request):
+    serializer = PriceSimulationSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    return Response(simulate_prices(serializer.validated_data["prices"], weeks=serializer.validated_data["weeks"]))
+
+
+def _plan_response(request, start, end, get_data, kinds=None, get_version=get_plan_version):
+    """Response with the plans of start to end days, tagged with their data
+    version: a request that already has this version gets a 304 and get_data is
+    not even called."""
+    version, modified = get_version(start, end)
+    etag = quote_etag(".".join([start.isoformat(), end.isoformat(), *(kinds or []), str(version)]))
+    last_modified = int(modified.timestamp()) if modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = Response(single_flight(request.resolver_match.view_name, etag, get_data))
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _get_kinds(section):
+    "Plan batches of a section of the actions page or of a batch name (API only), all of them when None"
+    if section is None:
+        return None
+    kind = SECTIONS.get(section, section)
+    if kind not in ProductionPlan.KIND:
+        raise Http404("Section inconnue")
+    return [kind]
+
+
+def _get_section_kinds(section):
+    "Plan batches of a section of the actions page, the printed plans being stored by section"
+    if section is not None and section not in SECTIONS:
+        raise Http404("Section inconnue")
+    return _get_kinds(section)
 
 
 @api_view(["GET"])
 @permission_classes([permissions.IsAdminUser])
 def get_actions(request, year, month, day):
-    return Response(_get_actions(date(year, month, day)))
+    target_date = date(year, month, day)
+    kinds = _get_kinds(request.query_params.get("section"))
+    return _plan_response(request, target_date, target_date, lambda: ActionsSerializer(get_cached_actions(target_date, kinds=kinds), context={"kinds": kinds}).data, kinds)
+
+
+def _get_date_range(year, month, day, to_year, to_month, to_day, max_days=MAX_RANGE_DAYS):
+    start, end = date(year, month, day), date(to_year, to_month, to_day)
+    if end < start or (end - start).days >= max_days:
+        raise Http404("Période invalide")
+    return start, end
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAdminUser])
+def get_range_actions(request, year, month, day, to_year, to_month, to_day):
+    start, end = _get_date_range(year, month, day, to_year, to_month, to_day)
+    kinds = _get_kinds(request.query_params.get("section"))
+
+    def get_data():
+        plans = build_range_actions(start, end, kinds=kinds)
+        return {day.isoformat(): ActionsSerializer(actions, context={"kinds": kinds}).data for day, actions in plans.items()}
+
+    return _plan_response(request, start, end, get_data, kinds)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAdminUser])
+def get_ingredient_forecast(request, year, month, day, to_year, to_month, to_day):
+    start, end = _get_date_range(year, month, day, to_year, to_month, to_day, MAX_FORECAST_DAYS)
+    include_unvalidated = request.query_params.get("unvalidated") == "1"
+
+    def get_data():
+        return IngredientForecastSerializer(get_cached_ingredient_forecast(start, end, include_unvalidated)).data
+
+    return _plan_response(request, start, end, get_data, ["unvalidated"] if include_unvalidated else None, get_delivery_version)
 
 
 # REGULAR VIEWS
@@ -258,7 +366,8 @@ def delete_order(request, order_id):
 def validate_orders(request, payment=False):
     available_timespan_start, available_timespan_end = _get_start_end_command_period()
     orders = (
-        Order.objects.filter(customer=request.user)
+        Order.objects.with_totals()
+        .filter(customer=request.user)
         .filter(validated=False)
         .filter(delivery_date__date__gte=available_timespan_start)
         .filter(delivery_date__date__lte=available_timespan_end)
@@ -350,6 +459,10 @@ def cancel_checkout(request):
     if checkout.customer != request.user:
         raise PermissionDenied
     remote_id = checkout.remote_id
+    # back in the cart, their line prices follow the catalogue again
+    for order in checkout.order_set.all():
+        order.checkout = None
+        order.save()
     checkout.delete()
     response = requests.delete(f"{SUMUP_CHECKOUTS_URL}/{remote_id}", headers={"Authorization": f"Bearer {SUMUP_API_KEY}"})
     response.raise_for_status()
@@ -358,7 +471,8 @@ def cancel_checkout(request):
 
 @login_required
 def checkouts(request):
-    checkouts = Checkout.objects.filter(customer=request.user).order_by("-id")
+    orders = Order.objects.with_totals().select_related("delivery_date__weekly_delivery__customer").prefetch_related("lines__product")
+    checkouts = Checkout.objects.filter(customer=request.user).prefetch_related(Prefetch("order_set", queryset=orders)).order_by("-id")
     return render(request, "boulange/checkouts.html", context={"checkouts": checkouts})
 
 
@@ -409,7 +523,8 @@ def orders(request, order_id=None, edit=False, duplicate=False):
     if order:
         products = weekly_delivery.get_available_products()
     validated_orders, cart, to_validate = [], [], []
-    for o in Order.objects.filter(customer=request.user).order_by("-id"):
+    user_orders = Order.objects.with_totals().filter(customer=request.user).select_related("checkout", "delivery_date__weekly_delivery__customer")
+    for o in user_orders.prefetch_related("lines__product").order_by("-id"):
         if o.validated:
             validated_orders.append(o)
         elif o.checkout:
@@ -434,7 +549,15 @@ def orders(request, order_id=None, edit=False, duplicate=False):
 
 @staff_required
 def products(request):
-    context = {"products": Product.objects.all()}
+    def get_products():
+        queryset = Product.objects.with_costs().select_related("orig_product").prefetch_related("raw_ingredients__ingredient")
+        return list(ProductFilter(request.GET, queryset=queryset).qs)
+
+    context = {
+        "products": single_flight("products", f"{get_catalogue_version()}:{request.GET.urlencode()}", get_products),
+        "ordering": request.GET.get("ordering", ""),
+        "orderings": PRODUCT_ORDERINGS,
+    }
     return render(request, "boulange/products.html", context)
 
 
@@ -445,12 +568,139 @@ def actions(request, year=None, month=None, day=None, to_print=False, section=No
     else:
         target_date = date(year, month, day)
     date_nav = []
-    for i in range(-5, 6):
+    for i in range(-NAV_DAYS, NAV_DAYS + 1):
         date_nav.append(target_date + timedelta(days=i))
-    context = {"actions": _get_actions(target_date), "target_date": target_date, "date_nav": date_nav, "to_print": to_print, "section": section}
+    actions = get_cached_actions(target_date, kinds=_get_section_kinds(section))
+    if to_print:
+        save_printed_plan(target_date, section, actions)
+    context = {
+        "actions": actions,
+        "target_date": target_date,
+        "date_nav": date_nav,
+        "week_end": target_date + timedelta(days=6),
+        "to_print": to_print,
+        "section": section,
+        "sections": LIVE_SECTIONS,
+        "live": settings.BOULANGE_LIVE_ACTIONS,
+        "version": get_plan_version(target_date, target_date)[0],
+    }
     return render(request, "boulange/actions.html", context)
 
 
+# sections of the actions page, in display order, each swapped on its own event
+LIVE_SECTIONS = ("boulange", "four", "livraison", "preparations")
+
+
+@staff_required
+def actions_section(request, section, year, month, day):
+    target_date = date(year, month, day)
+    context = {"actions": get_cached_actions(target_date, kinds=_get_section_kinds(section)), "target_date": target_date, "section": section}
+    return render(request, "boulange/hx/actions_section.html", context)
+
+
+async def actions_events(request, year, month, day):
+    "Server-sent events of the sections of the day whose plan changed, see events.plan_events"
+    if not settings.BOULANGE_LIVE_ACTIONS:
+        raise Http404("Pas de suivi en direct")
+    user = await request.auser()
+    if not user.is_staff:
+        raise PermissionDenied
+    version = request.headers.get("Last-Event-ID") or request.GET.get("version")
+    events = plan_events(date(year, month, day), int(version) if version and version.isdigit() else None)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # no buffering by a proxy in front
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@staff_required
+def actions_changes(request, section, year, month, day):
+    target_date = date(year, month, day)
+    _get_section_kinds(section)
+    printed, changes = get_plan_changes(target_date, section)
+    context = {"printed": printed, "changes": changes, "target_date": target_date, "section": section}
+    return render(request, "boulange/actions_changes.html", context)
+
+
+# how often the bakehouse screen asks for its plan again, in seconds
+SCREEN_REFRESH_SECONDS = 60
+
+
+@staff_required
+def actions_screen(request):
+    # same rounding as the bround template filter
+    context = {"nav_days": NAV_DAYS, "refresh_seconds": SCREEN_REFRESH_SECONDS, "special_units": list(SPECIAL_UNITS_WEIGHTS)}
+    return render(request, "boulange/actions_screen.html", context)
+
+
+def service_worker(request):
+    "Served under /actions/ so that it controls the bakehouse screen"
+    context = {
+        "shell": [
+            reverse("boulange:actions_screen"),
+            static("boulange/picnic.min.css"),
+            static("boulange/logo.jpg"),
+            static("boulange/actions_screen.js"),
+            static("boulange/manifest.webmanifest"),
+        ],
+        # what the screen reads, nothing else of the API
+        "api": [reverse("boulange:product-list"), reverse("boulange:ingredient-list")],
+        "actions_api": reverse("boulange:api-root") + "actions/",
+    }
+    response = render(request, "boulange/sw.js", context, content_type="text/javascript")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+class LogoutView(auth_views.LogoutView):
+    "Also empties the cache of the bakehouse screen service worker, which holds staff data"
+
+    def post(self, request, *args, **kwargs):
+        response = super().post(request, *args, **kwargs)
+        response.headers["Clear-Site-Data"] = '"cache", "storage"'
+        return response
+
+
+@staff_required
+def actions_range(request, year, month, day, to_year, to_month, to_day):
+    start, end = _get_date_range(year, month, day, to_year, to_month, to_day)
+    context = {"plans": build_range_actions(start, end), "start": start, "end": end}
+    return render(request, "boulange/actions_range.html", context)
+
+
+@staff_required
+def forecast(request, year=None, month=None, day=None, to_year=None, to_month=None, to_day=None):
+    if year is None:
+        start = date.today()
+        end = start + timedelta(days=6)
+    else:
+        start, end = _get_date_range(year, month, day, to_year, to_month, to_day, MAX_FORECAST_DAYS)
+    include_unvalidated = request.GET.get("unvalidated") == "1"
+    context = {
+        "forecast": get_cached_ingredient_forecast(start, end, include_unvalidated),
+        "start": start,
+        "end": end,
+        "include_unvalidated": include_unvalidated,
+        "horizons": [(weeks, start + timedelta(days=7 * weeks - 1)) for weeks in (1, 2, 4, 8)],
+    }
+    return render(request, "boulange/forecast.html", context)
+
+
+@staff_required
+def stock(request):
+    # the consumption is posted by the post_stock_consumption command, not here
+    today = date.today()
+    balances = get_stock_balances()
+    stock_outs = get_stock_outs(balances, today)
+    context = {
+        "stock": [(ingredient, balances[ingredient.pk], stock_outs.get(ingredient.pk)) for ingredient in Ingredient.objects.filter(pk__in=balances)],
+        "horizon_end": today + timedelta(days=STOCK_HORIZON_DAYS - 1),
+        "posted_until": get_posted_until(),
+    }
+    return render(request, "boulange/stock.html", context)
+
+
 @staff_required
 def check_delivery_dates_consistency(request):
     delivery_dates = DeliveryDate.objects.select_related("weekly_delivery").prefetch_related("order_set")
@@ -475,8 +725,8 @@ def check_delivery_dates_consistency(request):
 
 @login_required
 def delivery_receipt(request, delivery_date_id=None, filter_on_user=False):
-    delivery_date = get_object_or_404(DeliveryDate, id=delivery_date_id)
-    orders = delivery_date.order_set.filter(validated=True).select_related("customer").prefetch_related("lines__product")
+    delivery_date = get_object_or_404(DeliveryDate.objects.with_totals(), id=delivery_date_id)
+    orders = Order.objects.with_totals().filter(delivery_date=delivery_date, validated=True).select_related("customer").prefetch_related("lines__product")
     if filter_on_user or not request.user.is_staff:
         orders = orders.filter(customer=request.user)
     context = {"delivery_date": delivery_date, "orders": orders}
@@ -0,0 +1,3 @@
+SUMUP_API_KEY = "x"
+SUMUP_CHECKOUTS_URL = "http://localhost/checkouts"
+SUMUP_MERCHANT_CODE = "x"
@@ -134,6 +134,31 @@ REST_FRAMEWORK = {
     "DEFAULT_FILTER_BACKENDS": ["django_filters.rest_framework.DjangoFilterBackend"],
 }
 
+# "python" (order line by order line) or "numpy" (recipe matrices, see boulange.recipe_matrix)
+BOULANGE_PLANNING_ENGINE = "python"
+
+# room in one oven run, each unit baked takes Product.oven_space of it
+BOULANGE_OVEN_CAPACITY = 40
+
+# the actions page follows the plan changes over server-sent events: each open
+# page holds a request, so only under an ASGI server serving resto.asgi (e.g.
+# gunicorn -k uvicorn.workers.UvicornWorker resto.asgi), never with the sync
+# gunicorn workers of resto.wsgi. Off, the page is reloaded by hand.
+BOULANGE_LIVE_ACTIONS = False
+
+# "plans" holds the computed actions, shared by every worker and the
+# warm_plans_cache command; its table is created by `manage.py migrate` (0040)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "plans": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "boulange_plans_cache",
+        "TIMEOUT": 60 * 60 * 24,
+    },
+}
+
 LOGIN_REDIRECT_URL = "/orders"
 LOGOUT_REDIRECT_URL = "/"
 
@@ -18,8 +18,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from boulange.views import LogoutView
+
 urlpatterns = [
     path("", include("boulange.urls")),
     path("admin/", admin.site.urls),
+    path("accounts/logout/", LogoutView.as_view(), name="logout"),
     path("accounts/", include("django.contrib.auth.urls")),
 ]